@@ -1,6 +1,11 @@
 import logging
+import multiprocessing
 import os
+import threading
+from collections import OrderedDict
 from glob import glob
+from functools import partial
+from multiprocessing.pool import ThreadPool
 
 import SimpleITK as SimpleITK
 import cv2
@@ -8,17 +13,160 @@ import numpy as np
 import pydicom as dicom
 from pydicom.errors import InvalidDicomError
 
+from src.DicomProcessing.VolumeCache import VolumeCache
+
+# Worker processes are spawned rather than forked, as pools are created while other threads (e.g. the background
+# preprocessing, or the contouring and export threads of the UI) are running
+MP_CONTEXT = multiprocessing.get_context("spawn")
+
+# Number of quarter turns (np.rot90) applied to the DICOM stack to get the coronal plane
+ROTATION = 3
+
+# Orders of the preprocessing steps: upscale each slice then smooth it, smooth each slice at native resolution
+# then upscale it, or smooth the whole native volume in 3D then upscale each slice
+UPSCALE_FIRST = "upscale_first"
+SMOOTH_FIRST = "smooth_first"
+SMOOTH_VOLUME = "smooth_volume"
+PREPROCESSING_ORDERS = (UPSCALE_FIRST, SMOOTH_FIRST, SMOOTH_VOLUME)
+
+INTERPOLATIONS = {
+    "nearest": cv2.INTER_NEAREST,
+    "linear": cv2.INTER_LINEAR,
+    "cubic": cv2.INTER_CUBIC,
+    "area": cv2.INTER_AREA,
+}
+
+
+def contour_spacing(spacing, scaling_factor):
+    """
+    Gets the size in mm of a unit in contour coordinates. Contours are computed on the coronal slices, whose x axis
+    runs across the DICOM slices and y axis along the DICOM rows, both upscaled by scaling_factor. Consecutive
+    coronal slices are one DICOM column apart.
+    :param spacing: A dict with the pixel_spacing (row, column) and slice_thickness in mm, see
+    DicomManager.get_spacing
+    :param scaling_factor: The scaling factor of the slices
+    :return: The (x, y, slice) spacing, or None if the voxel spacing is not known
+    """
+    if (
+        spacing is None
+        or spacing.get("pixel_spacing") is None
+        or spacing.get("slice_thickness") is None
+    ):
+        return None
+    return (
+        spacing["slice_thickness"] / scaling_factor,
+        spacing["pixel_spacing"][0] / scaling_factor,
+        spacing["pixel_spacing"][1],
+    )
+
+
+def init_worker():
+    """
+    Initializer for preprocessing worker processes, parallelism comes from the pool instead of ITK threads
+    """
+    SimpleITK.ProcessObject.SetGlobalDefaultNumberOfThreads(1)
+
+
+def smooth(img, time_step, num_iterations):
+    """
+    Smooths an image with CurvatureFlow
+    :param img: The image to smooth, 2D or 3D
+    :param time_step: time step of the CurvatureFlow smoothing
+    :param num_iterations: number of iterations of the CurvatureFlow smoothing
+    :return: The smoothed image
+    """
+    img = SimpleITK.GetImageFromArray(img)
+
+    img_smooth = SimpleITK.CurvatureFlow(
+        image1=img, timeStep=time_step, numberOfIterations=num_iterations
+    )
+    return SimpleITK.GetArrayFromImage(img_smooth)
+
+
+def to_uint16(img):
+    """
+    Rounds and clips an image to uint16, the dtype of the raw DICOM data. The smoothed images are float, and
+    storing them as uint16 keeps the cache small and lets the display window them with a lookup table.
+    :param img: The image to convert
+    :return: The image as a uint16 array
+    """
+    if img.dtype == np.uint16:
+        return img
+    out = np.rint(img)
+    np.clip(out, 0, np.iinfo(np.uint16).max, out=out)
+    return out.astype(np.uint16)
+
+
+def preprocess_slice(
+    img,
+    scaling_factor,
+    time_step,
+    num_iterations,
+    order=UPSCALE_FIRST,
+    interpolation="nearest",
+):
+    """
+    Resizes and smooths a single slice
+    :param img: The slice to process
+    :param scaling_factor: integer for scaling how many pixels per point in DICOM image
+    :param time_step: time step of the CurvatureFlow smoothing
+    :param num_iterations: number of iterations of the CurvatureFlow smoothing
+    :param order: one of PREPROCESSING_ORDERS. With SMOOTH_VOLUME the slice is only resized, as the volume is
+    expected to be smoothed already
+    :param interpolation: the interpolation used for resizing, one of the keys of INTERPOLATIONS
+    :return: The processed slice as uint16
+    """
+    if order == SMOOTH_FIRST:
+        img = smooth(img, time_step, num_iterations)
+
+    dst = cv2.resize(
+        img,
+        dsize=None,
+        fx=scaling_factor,
+        fy=scaling_factor,
+        interpolation=INTERPOLATIONS[interpolation],
+    )
+
+    if order == UPSCALE_FIRST:
+        dst = smooth(dst, time_step, num_iterations)
+    return to_uint16(dst)
+
 
 class DicomManager:
     """
     Class for managing the DICOM data
     """
 
-    def __init__(self, data_path=None, scaling_factor=4):
+    def __init__(
+        self,
+        data_path=None,
+        scaling_factor=4,
+        num_workers=None,
+        time_step=0.05,
+        num_iterations=20,
+        progress_callback=None,
+        preprocessing_order=UPSCALE_FIRST,
+        interpolation="nearest",
+        lazy=False,
+        cache_size=64,
+        prefetch=2,
+    ):
         """
         DicomManager constructor
         :param data_path: path to precomputed .npy or raw DICOM files
         :param scaling_factor: integer for scaling how many pixels per point in DICOM image
+        :param num_workers: number of workers used for loading, defaults to the number of CPUs
+        :param time_step: time step of the CurvatureFlow smoothing
+        :param num_iterations: number of iterations of the CurvatureFlow smoothing
+        :param progress_callback: optional callable (done, total) for reporting preprocessing progress
+        :param preprocessing_order: one of PREPROCESSING_ORDERS. Smoothing before upscaling runs CurvatureFlow
+        over scaling_factor**2 fewer pixels
+        :param interpolation: the interpolation used for upscaling, one of the keys of INTERPOLATIONS
+        :param lazy: if no preprocessed images are cached, preprocess each slice on first access while the whole
+        volume is preprocessed and cached in the background, instead of preprocessing it up front
+        :param cache_size: number of preprocessed slices kept in memory in lazy mode
+        :param prefetch: number of slices on either side of the requested slice preprocessed in the background
+        in lazy mode
         """
 
         self.logger = logging.getLogger(__name__)
@@ -27,48 +175,200 @@ class DicomManager:
             self.output_path = os.path.join(data_path, "saved_dicom_imgs")
         else:
             raise RuntimeError("DicomManager requires a valid path for construction.")
+        if preprocessing_order not in PREPROCESSING_ORDERS:
+            raise ValueError(
+                "Unknown preprocessing order: {}".format(preprocessing_order)
+            )
+        if interpolation not in INTERPOLATIONS:
+            raise ValueError("Unknown interpolation: {}".format(interpolation))
+        if lazy and preprocessing_order == SMOOTH_VOLUME:
+            raise ValueError("Lazy loading cannot smooth the volume in 3D")
         self.scaling_factor = scaling_factor
+        self.num_workers = num_workers
+        self.time_step = time_step
+        self.num_iterations = num_iterations
+        self.preprocessing_order = preprocessing_order
+        self.interpolation = interpolation
+        self.cache = VolumeCache(os.path.join(self.output_path, "cache"))
+        self.source_entries = []
+        # Row and column spacing of the DICOM pixels and the distance between DICOM slices, in mm
+        self.pixel_spacing = None
+        self.slice_thickness = None
+        self.progress_callback = progress_callback
+        self.pending_imgs = None
         self.imgs = np.zeros((0, 0))
+
+        # Lazy loading state, self.raw_imgs holds the unprocessed slices while lazy loading
+        self.lazy = lazy
+        self.raw_imgs = None
+        self.background_thread = None
+        self.stopped = threading.Event()
+        self.cache_size = cache_size
+        self.prefetch = prefetch
+        self.slice_cache = OrderedDict()
+        self.pending_slices = {}
+        self.slice_lock = threading.Lock()
+        self.prefetch_pool = None
         self.init_from_folder(data_path)
 
     def init_from_folder(self, data_path):
         """
-        Load images from the data at data_path.
+        Load images from the data at data_path. Preprocessed images are reused from the cache when they were
+        computed from the same files with the same preprocessing parameters.
         :param data_path: The path to load the data from
         """
         self.logger.info("Initializing from path: {}".format(data_path))
-        try:
-            self.imgs = np.load(os.path.join(self.output_path, "output.npy"))
-        except (FileNotFoundError, IOError):
-            self.logger.info(
-                "Could not find stored images in data_path, reading in DICOM"
-            )
-            g = glob(data_path + "/*.dcm")
-            if len(g) == 0:
+        self.source_entries = VolumeCache.source_entries(data_path)
+        params = self.get_preprocessing_params()
+
+        self.imgs = self.cache.load_processed(params, self.source_entries)
+        if self.imgs is not None:
+            self.logger.info("Loaded preprocessed images from cache")
+            self.set_spacing(self.cache.read_spacing())
+            self.lazy = False
+            return
+
+        g = glob(data_path + "/*.dcm")
+        if len(g) == 0:
+            try:
+                # Memory map images stored before the cache kept track of its source files
+                self.imgs = np.load(
+                    os.path.join(self.output_path, "output.npy"), mmap_mode="r"
+                )
+                self.logger.warning("Using stored images without DICOM data")
+                self.lazy = False
+                return
+            except (FileNotFoundError, IOError):
                 raise RuntimeError("Could not find any DICOM data")
 
-            self.logger.info("Found {} DICOM images".format(len(g)))
-            scan_data = self.load_scan(data_path)
-            self.imgs = self.get_pixels(scan_data)
-            self.resize_imgs()
-            self.save_data()
+        self.logger.info("Found {} DICOM images".format(len(g)))
+        scan_data = self.load_scan(data_path)
+        self.set_spacing(self.spacing_from_scans(scan_data))
+        raw = self.cache.update_raw(
+            scan_data,
+            self.source_entries,
+            lambda scans, images, indices: self.decode_pixels(
+                scans, images, indices, self.num_workers
+            ),
+            self.get_spacing(),
+        )
+        self.imgs = np.rot90(raw, k=ROTATION, axes=(0, 2))
+        if self.lazy:
+            self.logger.info("Preprocessing slices on demand")
+            self.raw_imgs = self.imgs
+            self.background_thread = threading.Thread(
+                target=self.finish_preprocessing, daemon=True
+            )
+            self.background_thread.start()
+            return
+        self.resize_imgs()
+        self.save_data()
+
+    @staticmethod
+    def spacing_from_scans(scans):
+        """
+        Gets the voxel spacing of a volume
+        :param scans: A list of DICOM slices, as returned by load_scan
+        :return: A dict with the pixel_spacing (row, column) and slice_thickness in mm
+        """
+        pixel_spacing = getattr(scans[0], "PixelSpacing", None)
+        return {
+            "pixel_spacing": (
+                [float(v) for v in pixel_spacing] if pixel_spacing is not None else None
+            ),
+            "slice_thickness": float(scans[0].SliceThickness),
+        }
+
+    def set_spacing(self, spacing):
+        """
+        Sets the voxel spacing of this DicomManager
+        :param spacing: A dict as returned by spacing_from_scans, or None if the spacing is not known
+        """
+        if spacing is None:
+            self.logger.warning("Voxel spacing is not known")
+            return
+        self.pixel_spacing = spacing.get("pixel_spacing")
+        self.slice_thickness = spacing.get("slice_thickness")
+
+    def get_spacing(self):
+        """
+        Gets the voxel spacing of this DicomManager
+        :return: A dict with the pixel_spacing (row, column) and slice_thickness in mm, either may be None
+        """
+        return {
+            "pixel_spacing": self.pixel_spacing,
+            "slice_thickness": self.slice_thickness,
+        }
+
+    def get_contour_spacing(self):
+        """
+        Gets the size in mm of a unit in contour coordinates, see contour_spacing
+        :return: The (x, y, slice) spacing, or None if the voxel spacing is not known
+        """
+        return contour_spacing(self.get_spacing(), self.scaling_factor)
+
+    def get_preprocessing_params(self):
+        """
+        Gets the parameters that determine the preprocessed images
+        :return: A dict of the preprocessing parameters
+        """
+        return {
+            "scaling_factor": self.scaling_factor,
+            "interpolation": self.interpolation,
+            "order": self.preprocessing_order,
+            "time_step": self.time_step,
+            "num_iterations": self.num_iterations,
+            "rotation": ROTATION,
+            "dtype": "uint16",
+        }
+
+    def get_slice_kwargs(self):
+        """
+        Gets the keyword arguments for preprocess_slice
+        :return: A dict of keyword arguments
+        """
+        return {
+            "scaling_factor": self.scaling_factor,
+            "time_step": self.time_step,
+            "num_iterations": self.num_iterations,
+            "order": self.preprocessing_order,
+            "interpolation": self.interpolation,
+        }
 
     def load_scan(self, data_path):
         """
-        Loads DICOM data from data_path
+        Loads the DICOM headers from data_path. Pixel data is not read here, see get_pixels.
         :param data_path: The path to the DICOM data
-        :return: A list of the slices within the DICOM data set
+        :return: A list of the slices within the DICOM data set, sorted by InstanceNumber
         """
+        paths = [os.path.join(data_path, s) for s in os.listdir(data_path)]
+        with ThreadPool(self.num_workers) as pool:
+            headers = pool.map(self.read_header, paths)
+
         slices = []
-        for s in os.listdir(data_path):
-            try:
-                slices.append(dicom.read_file(data_path + "/" + s))
-            except InvalidDicomError:
-                self.logger.warning("Could not load {}".format(s))
-            except IsADirectoryError:
-                self.logger.info("Skipping directory {}".format(s))
+        for path, header in zip(paths, headers):
+            if header is None:
+                continue
+            if not hasattr(header, "Rows") or not hasattr(header, "InstanceNumber"):
+                self.logger.warning("Skipping non-image DICOM {}".format(path))
+                continue
+            slices.append(header)
+
+        if len(slices) < 2:
+            raise RuntimeError("Need at least two DICOM slices to build a volume")
 
         slices.sort(key=lambda x: int(x.InstanceNumber))
+
+        shape = (slices[0].Rows, slices[0].Columns)
+        valid_slices = [s for s in slices if (s.Rows, s.Columns) == shape]
+        if len(valid_slices) != len(slices):
+            self.logger.warning(
+                "Dropped {} slices not matching {}x{}".format(
+                    len(slices) - len(valid_slices), shape[0], shape[1]
+                )
+            )
+            slices = valid_slices
+
         try:
             slice_thickness = np.abs(
                 slices[0].ImagePositionPatient[2] - slices[1].ImagePositionPatient[2]
@@ -81,73 +381,273 @@ class DicomManager:
 
         return slices
 
+    def read_header(self, path):
+        """
+        Reads the DICOM header at path, stopping before the pixel data
+        :param path: The path to the DICOM file
+        :return: The DICOM header, or None if path is not a DICOM file
+        """
+        try:
+            return dicom.dcmread(path, stop_before_pixels=True)
+        except InvalidDicomError:
+            self.logger.warning("Could not load {}".format(path))
+        except IsADirectoryError:
+            self.logger.info("Skipping directory {}".format(path))
+        return None
+
     @staticmethod
-    def get_pixels(scans):
+    def get_pixels(scans, num_workers=None):
         """
-        Returns pixel values from a set of DICOM slices
-        :param scans: A list of DICOM slices
+        Returns pixel values from a set of DICOM slices. The pixel data for each slice is decoded in
+        parallel straight into a single preallocated volume.
+        :param scans: A list of DICOM slices, as returned by load_scan
+        :param num_workers: The number of decoding threads, defaults to the number of CPUs
         :return: An array of the images, rotated to give the coronal plane
         """
-        images = np.stack([s.pixel_array for s in scans])
+        images = np.empty(
+            (len(scans), scans[0].Rows, scans[0].Columns), dtype=np.uint16
+        )
+        DicomManager.decode_pixels(scans, images, range(len(scans)), num_workers)
 
-        # Convert to int16 (from sometimes int16),
-        # should be possible as values should always be low enough (<32k)
+        # rotate image to get different slice, np.rot90 returns a view so no copy is made
+        return np.rot90(images, k=ROTATION, axes=(0, 2))
 
-        # rotate image to get different slice
-        img_rot = np.rot90(images, k=3, axes=(0, 2))
-        return np.array(img_rot, dtype=np.uint16)
+    @staticmethod
+    def decode_pixels(scans, images, indices, num_workers=None):
+        """
+        Decodes the pixel data of the given slices in parallel.
+        :param scans: A list of DICOM slices, as returned by load_scan
+        :param images: The preallocated volume to decode into
+        :param indices: The indices of the slices to decode
+        :param num_workers: The number of decoding threads, defaults to the number of CPUs
+        """
+
+        def decode(idx):
+            # Values should always be low enough (<32k) to fit in uint16
+            images[idx] = dicom.dcmread(scans[idx].filename).pixel_array
+
+        with ThreadPool(num_workers) as pool:
+            pool.map(decode, indices)
 
     def resize_imgs(self):
         """
-        Resizes and smooths the images in this DicomManager
+        Resizes and smooths the images in this DicomManager. Slices are processed in parallel by a process pool
+        and written straight into a preallocated volume in the cache, see save_data.
         """
-        img_list = []
-        for idx, s in enumerate(self.imgs):
-            dst = cv2.resize(
-                s,
-                dsize=None,
-                fx=self.scaling_factor,
-                fy=self.scaling_factor,
-                interpolation=cv2.INTER_NEAREST,
+        num_imgs = len(self.imgs)
+        slice_kwargs = self.get_slice_kwargs()
+
+        if self.preprocessing_order == SMOOTH_VOLUME:
+            self.logger.info("Smoothing volume")
+            self.imgs = smooth(
+                np.ascontiguousarray(self.imgs), self.time_step, self.num_iterations
             )
 
-            img = SimpleITK.GetImageFromArray(dst)
+        # The first slice determines the shape and dtype of the output
+        first = preprocess_slice(np.ascontiguousarray(self.imgs[0]), **slice_kwargs)
+        out = self.cache.create_processed(
+            self.get_preprocessing_params(), (num_imgs,) + first.shape, first.dtype
+        )
+        out[0] = first
+        self.report_progress(1, num_imgs)
 
-            img_smooth = SimpleITK.CurvatureFlow(
-                image1=img, timeStep=0.05, numberOfIterations=20
+        num_workers = self.num_workers or os.cpu_count()
+        chunksize = max(1, num_imgs // (num_workers * 4))
+        with MP_CONTEXT.Pool(num_workers, initializer=init_worker) as pool:
+            results = pool.imap(
+                partial(preprocess_slice, **slice_kwargs),
+                (np.ascontiguousarray(s) for s in self.imgs[1:]),
+                chunksize=chunksize,
             )
-            s = SimpleITK.GetArrayFromImage(img_smooth)
+            for idx, s in enumerate(results, 1):
+                if self.stopped.is_set():
+                    raise RuntimeError("Preprocessing was stopped")
+                out[idx] = s
+                self.report_progress(idx + 1, num_imgs)
+
+        self.imgs = self.pending_imgs = out
+
+    def finish_preprocessing(self):
+        """
+        Preprocesses and caches the whole volume in the background while slices are served lazily, then serves
+        the slices from the cached volume
+        """
+        try:
+            self.resize_imgs()
+            self.save_data()
+        except Exception:
+            if self.stopped.is_set():
+                self.logger.info("Background preprocessing stopped")
+            else:
+                self.logger.exception("Background preprocessing failed")
+            return
+
+        with self.slice_lock:
+            self.lazy = False
+            self.slice_cache.clear()
+            self.pending_slices.clear()
+            prefetch_pool = self.prefetch_pool
+            self.prefetch_pool = None
+        if prefetch_pool is not None:
+            # Let slices that are still being waited for finish
+            prefetch_pool.close()
+        self.logger.info("Serving slices from the cached volume")
 
-            img_list.append(s)
-        self.imgs = np.asarray(img_list)
+    def report_progress(self, done, total):
+        """
+        Reports the preprocessing progress to the log and the progress callback
+        :param done: The number of slices processed
+        :param total: The total number of slices
+        """
+        if self.progress_callback is not None:
+            self.progress_callback(done, total)
+        if done == total or done % max(1, total // 10) == 0:
+            self.logger.info("Preprocessed {}/{} slices".format(done, total))
 
     def save_data(self):
         """
-        Saves the preprocessed images within this DicomManager
+        Saves the preprocessed images within this DicomManager to the cache. The images are written slice by
+        slice with one contiguous block per slice, and are then memory mapped in place of the in-memory images.
         """
-        if not os.path.exists(self.output_path):
-            os.mkdir(self.output_path)
-        np.save(os.path.join(self.output_path, "output.npy"), self.imgs)
+        params = self.get_preprocessing_params()
+        if self.imgs is self.pending_imgs:
+            # resize_imgs already wrote the images into the cache
+            out = self.pending_imgs
+        else:
+            out = self.cache.create_processed(params, self.imgs.shape, self.imgs.dtype)
+            for idx, s in enumerate(self.imgs):
+                out[idx] = s
+        self.pending_imgs = None
+        self.imgs = self.cache.commit_processed(params, self.source_entries, out)
 
     def get_image_array(self, idx):
         """
-        Returns the image at idx
+        Returns the image at idx. In lazy mode the image is preprocessed on first access, and its neighbours
+        are preprocessed in the background.
         :param idx: The index of the requested index
         :return: The image at idx, or None if idx is invalid
         """
         valid_idx = idx < len(self.imgs)
         valid_imgs = self.imgs is not None
         if valid_idx and valid_imgs:
+            if self.lazy:
+                idx %= len(self.imgs)
+                img = self.get_processed_slice(idx)
+                self.prefetch_slices(idx)
+                return img
             return self.imgs[idx]
 
         return None
 
+    def is_slice_ready(self, idx):
+        """
+        Checks whether get_image_array can return the image at idx without preprocessing it or waiting for it
+        :param idx: The index of the image
+        :return: True if the image is ready
+        """
+        with self.slice_lock:
+            return not self.lazy or idx % len(self.imgs) in self.slice_cache
+
+    def get_preview_array(self, idx):
+        """
+        Gets the unprocessed image at idx resized to the size of the preprocessed images, for display while the
+        image is preprocessed in lazy mode
+        :param idx: The index of the image
+        :return: The resized, unsmoothed image
+        """
+        if not self.lazy:
+            return self.imgs[idx]
+        return cv2.resize(
+            np.ascontiguousarray(self.raw_imgs[idx % len(self.raw_imgs)]),
+            dsize=None,
+            fx=self.scaling_factor,
+            fy=self.scaling_factor,
+            interpolation=INTERPOLATIONS[self.interpolation],
+        )
+
+    def get_processed_slice(self, idx):
+        """
+        Gets a preprocessed slice from the slice cache, preprocessing it if needed
+        :param idx: The index of the slice
+        :return: The preprocessed slice
+        """
+        with self.slice_lock:
+            img = self.slice_cache.get(idx)
+            if img is not None:
+                self.slice_cache.move_to_end(idx)
+                return img
+            pending = self.pending_slices.get(idx)
+
+        if pending is not None:
+            img = pending.get()
+        else:
+            img = preprocess_slice(
+                np.ascontiguousarray(self.raw_imgs[idx]), **self.get_slice_kwargs()
+            )
+        self.store_slice(idx, img)
+        return img
+
+    def store_slice(self, idx, img):
+        """
+        Adds a preprocessed slice to the slice cache, evicting the least recently used slices
+        :param idx: The index of the slice
+        :param img: The preprocessed slice
+        """
+        with self.slice_lock:
+            self.pending_slices.pop(idx, None)
+            self.slice_cache[idx] = img
+            self.slice_cache.move_to_end(idx)
+            while len(self.slice_cache) > self.cache_size:
+                self.slice_cache.popitem(last=False)
+
+    def prefetch_slices(self, idx):
+        """
+        Preprocesses the neighbours of idx in background worker processes
+        :param idx: The index of the slice being viewed
+        """
+        if self.prefetch <= 0:
+            return
+        num_imgs = len(self.imgs)
+        with self.slice_lock:
+            if not self.lazy:
+                return
+            if self.prefetch_pool is None:
+                num_workers = min(self.num_workers or os.cpu_count(), 2 * self.prefetch)
+                self.prefetch_pool = MP_CONTEXT.Pool(
+                    num_workers, initializer=init_worker
+                )
+            for offset in range(1, self.prefetch + 1):
+                for neighbour in (idx + offset, idx - offset):
+                    neighbour %= num_imgs
+                    if (
+                        neighbour in self.slice_cache
+                        or neighbour in self.pending_slices
+                    ):
+                        continue
+                    self.pending_slices[neighbour] = self.prefetch_pool.apply_async(
+                        preprocess_slice,
+                        (np.ascontiguousarray(self.raw_imgs[neighbour]),),
+                        self.get_slice_kwargs(),
+                        callback=partial(self.store_slice, neighbour),
+                    )
+
+    def close(self):
+        """
+        Stops the background workers of this DicomManager
+        """
+        self.stopped.set()
+        if self.prefetch_pool is not None:
+            self.prefetch_pool.terminate()
+            self.prefetch_pool = None
+        with self.slice_lock:
+            self.pending_slices.clear()
+
     def get_num_images(self):
         """
         Gets the number of images in this DicomManager
         :return: The number of images in this DicomManager
         """
-        num_imgs = np.shape(self.imgs)[-1]
+        num_imgs = np.shape(self.imgs)[0]
         return num_imgs
 
     def get_scaling_factor(self):
@@ -0,0 +1,216 @@
+import hashlib
+import json
+import logging
+import os
+
+import numpy as np
+
+CACHE_VERSION = 1
+
+
+class VolumeCache:
+    """
+    On-disk cache for the volumes computed by DicomManager.
+
+    The raw volume (pixel data in InstanceNumber order) is stored once per study together with a manifest of the
+    source files it was decoded from. Preprocessed volumes are stored in one folder per set of preprocessing
+    parameters, so different parameter sets can coexist. Every preprocessed volume records the source files it
+    was computed from and is discarded once they change.
+    """
+
+    def __init__(self, cache_path):
+        """
+        VolumeCache constructor
+        :param cache_path: The folder to store the cached volumes in
+        """
+        self.logger = logging.getLogger(__name__)
+        self.cache_path = cache_path
+
+    @staticmethod
+    def source_entries(data_path, exclude=()):
+        """
+        Describes the files in data_path by name, size and modification time.
+        :param data_path: The folder holding the source files
+        :param exclude: Names within data_path to ignore
+        :return: A list of entries, sorted by name
+        """
+        entries = []
+        for name in sorted(os.listdir(data_path)):
+            if name in exclude:
+                continue
+            path = os.path.join(data_path, name)
+            if not os.path.isfile(path):
+                continue
+            stat = os.stat(path)
+            entries.append(
+                {"name": name, "size": stat.st_size, "mtime": stat.st_mtime_ns}
+            )
+        return entries
+
+    @staticmethod
+    def digest(obj):
+        """
+        Computes a stable digest of a JSON serializable object.
+        :param obj: The object to digest
+        :return: A hex digest
+        """
+        encoded = json.dumps(obj, sort_keys=True).encode("utf-8")
+        return hashlib.sha1(encoded).hexdigest()
+
+    def params_path(self, params):
+        """
+        Gets the folder for the volume preprocessed with params.
+        :param params: A dict of the preprocessing parameters
+        :return: The folder for this parameter set
+        """
+        return os.path.join(self.cache_path, self.digest(params)[:16])
+
+    def load_processed(self, params, entries):
+        """
+        Opens the cached volume preprocessed with params, if it is still valid for the source files.
+        :param params: A dict of the preprocessing parameters
+        :param entries: The current source entries, see source_entries
+        :return: The memory mapped volume, or None if there is no valid cached volume
+        """
+        folder = self.params_path(params)
+        manifest = self.read_manifest(os.path.join(folder, "manifest.json"))
+        if manifest is None:
+            return None
+        if manifest.get("params") != params:
+            self.logger.warning("Parameter mismatch in {}".format(folder))
+            return None
+        if manifest.get("source") != self.digest(entries):
+            self.logger.info(
+                "Source files changed since {} was computed".format(folder)
+            )
+            return None
+        try:
+            return np.load(os.path.join(folder, "output.npy"), mmap_mode="r")
+        except (FileNotFoundError, IOError, ValueError):
+            return None
+
+    def create_processed(self, params, shape, dtype):
+        """
+        Creates the memory mapped file a preprocessed volume is written into. The volume is not valid
+        until commit_processed is called.
+        :param params: A dict of the preprocessing parameters
+        :param shape: The shape of the preprocessed volume
+        :param dtype: The dtype of the preprocessed volume
+        :return: A writable memory mapped array
+        """
+        folder = self.params_path(params)
+        os.makedirs(folder, exist_ok=True)
+        return np.lib.format.open_memmap(
+            os.path.join(folder, "output.npy.tmp"), mode="w+", dtype=dtype, shape=shape
+        )
+
+    def commit_processed(self, params, entries, volume):
+        """
+        Finalizes a volume created with create_processed.
+        :param params: A dict of the preprocessing parameters
+        :param entries: The source entries the volume was computed from
+        :param volume: The array returned by create_processed
+        :return: The committed volume, memory mapped read only
+        """
+        folder = self.params_path(params)
+        volume.flush()
+        del volume
+
+        output_file = os.path.join(folder, "output.npy")
+        os.replace(output_file + ".tmp", output_file)
+        self.write_manifest(
+            os.path.join(folder, "manifest.json"),
+            {"params": params, "source": self.digest(entries)},
+        )
+        return np.load(output_file, mmap_mode="r")
+
+    def update_raw(self, scans, entries, decode, spacing=None):
+        """
+        Brings the cached raw volume up to date with the source files. Only slices whose file is new or has
+        changed are decoded, all others are copied over from the previous raw volume.
+        :param scans: The DICOM headers of the volume, in slice order
+        :param entries: The current source entries, see source_entries
+        :param decode: Callable (scans, images, indices) decoding scans[i] into images[i] for i in indices
+        :param spacing: An optional JSON serializable dict of the voxel spacing, stored in the manifest
+        :return: The raw volume of shape (slices, rows, columns), memory mapped read only
+        """
+        os.makedirs(self.cache_path, exist_ok=True)
+        raw_file = os.path.join(self.cache_path, "raw.npy")
+        shape = (len(scans), scans[0].Rows, scans[0].Columns)
+
+        by_name = {e["name"]: e for e in entries}
+        files = [by_name[os.path.basename(s.filename)] for s in scans]
+
+        old_idx = {}
+        old_raw = None
+        manifest = self.read_manifest(os.path.join(self.cache_path, "raw.json"))
+        if manifest is not None and tuple(manifest.get("shape", ())[1:]) == shape[1:]:
+            try:
+                old_raw = np.load(raw_file, mmap_mode="r")
+                old_idx = {
+                    self.digest(f): idx for idx, f in enumerate(manifest["files"])
+                }
+            except (FileNotFoundError, IOError, ValueError):
+                old_raw = None
+
+        images = np.lib.format.open_memmap(
+            raw_file + ".tmp", mode="w+", dtype=np.uint16, shape=shape
+        )
+        changed = []
+        for idx, f in enumerate(files):
+            prev = old_idx.get(self.digest(f))
+            if old_raw is not None and prev is not None:
+                images[idx] = old_raw[prev]
+            else:
+                changed.append(idx)
+
+        self.logger.info("Decoding {} of {} slices".format(len(changed), len(scans)))
+        decode(scans, images, changed)
+        images.flush()
+        del images
+        del old_raw
+
+        os.replace(raw_file + ".tmp", raw_file)
+        self.write_manifest(
+            os.path.join(self.cache_path, "raw.json"),
+            {"shape": list(shape), "files": files, "spacing": spacing},
+        )
+        return np.load(raw_file, mmap_mode="r")
+
+    def read_spacing(self):
+        """
+        Reads the voxel spacing stored with the raw volume.
+        :return: The spacing dict passed to update_raw, or None if it is not known
+        """
+        manifest = self.read_manifest(os.path.join(self.cache_path, "raw.json"))
+        if manifest is None:
+            return None
+        return manifest.get("spacing")
+
+    @staticmethod
+    def read_manifest(path):
+        """
+        Reads a manifest written by this cache.
+        :param path: The path to the manifest
+        :return: The manifest, or None if it is missing or from another version of the cache
+        """
+        try:
+            with open(path, "r") as manifest_file:
+                manifest = json.load(manifest_file)
+        except (FileNotFoundError, IOError, ValueError):
+            return None
+        if manifest.get("version") != CACHE_VERSION:
+            return None
+        return manifest
+
+    @staticmethod
+    def write_manifest(path, manifest):
+        """
+        Writes a manifest for this cache.
+        :param path: The path to the manifest
+        :param manifest: A JSON serializable dict
+        """
+        manifest = dict(manifest, version=CACHE_VERSION)
+        with open(path + ".tmp", "w") as manifest_file:
+            json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+        os.replace(path + ".tmp", path)
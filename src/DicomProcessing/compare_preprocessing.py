@@ -0,0 +1,138 @@
+"""
+Compares the speed of the DicomManager preprocessing orders and how closely their contours match the default
+upscale-then-smooth order.
+
+Usage: python -m src.DicomProcessing.compare_preprocessing <DICOM folder> [--scale 4] [--slices 10] [--thresh 70]
+"""
+
+import argparse
+import time
+from glob import glob
+
+import cv2
+import numpy as np
+import pydicom as dicom
+from PIL import Image
+
+from src.DicomProcessing.DicomManager import (
+    DicomManager,
+    PREPROCESSING_ORDERS,
+    ROTATION,
+    SMOOTH_VOLUME,
+    UPSCALE_FIRST,
+    preprocess_slice,
+    smooth,
+)
+from src.ImageProcessing.contouring import cnt_from_img
+
+
+def load_volume(data_path):
+    """
+    Loads the coronal slices of the DICOM data in data_path, without preprocessing
+    :param data_path: The path to the DICOM data
+    :return: An array of the coronal slices
+    """
+    scans = [
+        dicom.dcmread(path, stop_before_pixels=True)
+        for path in glob(data_path + "/*.dcm")
+    ]
+    scans.sort(key=lambda x: int(x.InstanceNumber))
+    images = np.empty((len(scans), scans[0].Rows, scans[0].Columns), dtype=np.uint16)
+    DicomManager.decode_pixels(scans, images, range(len(scans)))
+    return np.rot90(images, k=ROTATION, axes=(0, 2))
+
+
+def preprocess(
+    volume, indices, order, interpolation, scaling_factor, time_step, num_iterations
+):
+    """
+    Preprocesses the slices at indices of volume
+    :return: A list of the processed slices and the time taken in seconds
+    """
+    start = time.perf_counter()
+    if order == SMOOTH_VOLUME:
+        volume = smooth(np.ascontiguousarray(volume), time_step, num_iterations)
+    processed = [
+        preprocess_slice(
+            np.ascontiguousarray(volume[idx]),
+            scaling_factor,
+            time_step,
+            num_iterations,
+            order=order,
+            interpolation=interpolation,
+        )
+        for idx in indices
+    ]
+    return processed, time.perf_counter() - start
+
+
+def contour_mask(img, thresh_val):
+    """
+    Rasterizes the largest contour of img
+    :return: A binary mask of the largest contour, and the number of contours found
+    """
+    contours = cnt_from_img(Image.fromarray(img), thresh_val)
+    mask = np.zeros(img.shape, dtype=np.uint8)
+    if contours:
+        cv2.drawContours(mask, contours, 0, 1, thickness=cv2.FILLED)
+    return mask, len(contours)
+
+
+def compare(reference, candidate, thresh_val):
+    """
+    Compares the contours of two sets of processed slices
+    :return: The mean IoU of the largest contours and the mean relative difference in the number of contours
+    """
+    ious = []
+    count_diffs = []
+    for ref_img, img in zip(reference, candidate):
+        ref_mask, ref_count = contour_mask(ref_img, thresh_val)
+        mask, count = contour_mask(img, thresh_val)
+        union = np.count_nonzero(ref_mask | mask)
+        ious.append(np.count_nonzero(ref_mask & mask) / union if union else 1.0)
+        count_diffs.append(abs(count - ref_count) / max(ref_count, 1))
+    return np.mean(ious), np.mean(count_diffs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("data_path", help="folder with the DICOM data")
+    parser.add_argument("--scale", type=int, default=4, help="scaling factor")
+    parser.add_argument(
+        "--slices", type=int, default=10, help="number of slices to sample"
+    )
+    parser.add_argument("--thresh", type=int, default=70, help="contouring threshold")
+    parser.add_argument("--time-step", type=float, default=0.05)
+    parser.add_argument("--iterations", type=int, default=20)
+    args = parser.parse_args()
+
+    volume = load_volume(args.data_path)
+    indices = np.linspace(0, len(volume) - 1, min(args.slices, len(volume))).astype(int)
+    settings = (args.scale, args.time_step, args.iterations)
+
+    reference, ref_time = preprocess(
+        volume, indices, UPSCALE_FIRST, "nearest", *settings
+    )
+    print(
+        "{:<14} {:<8} {:>9} {:>8} {:>8} {:>11}".format(
+            "order", "interp", "time (s)", "speedup", "IoU", "count diff"
+        )
+    )
+    for order in PREPROCESSING_ORDERS:
+        for interpolation in ("nearest", "linear", "cubic"):
+            if order == UPSCALE_FIRST and interpolation == "nearest":
+                processed, elapsed = reference, ref_time
+            else:
+                processed, elapsed = preprocess(
+                    volume, indices, order, interpolation, *settings
+                )
+            iou, count_diff = compare(reference, processed, args.thresh)
+            print(
+                "{:<14} {:<8} {:>9.3f} {:>7.1f}x {:>8.3f} {:>10.1%}".format(
+                    order, interpolation, elapsed, ref_time / elapsed, iou, count_diff
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+"""
+Batch contour extraction over every slice of a study.
+
+Usage: python -m src.ImageProcessing.batch_contouring <DICOM or image folder> [--thresh 70] [--output contours]
+"""
+
+import argparse
+import logging
+import os
+from glob import glob
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from src.DicomProcessing.DicomManager import MP_CONTEXT, DicomManager, preprocess_slice
+from src.ImageProcessing.contouring import ContouringEngine
+from src.PostProcessing.contour_archive import ARCHIVE_NAME, ContourArchive
+
+logger = logging.getLogger(__name__)
+logger.setLevel(10)
+
+IMAGE_EXTENSIONS = (".bmp", ".png", ".jpg", ".jpeg", ".tif", ".tiff")
+
+APPROXIMATIONS = {
+    "none": cv2.CHAIN_APPROX_NONE,
+    "simple": cv2.CHAIN_APPROX_SIMPLE,
+}
+
+# Per process state of the batch workers
+worker_engines = {}
+worker_volumes = {}
+
+
+def slice_tasks(source):
+    """
+    Describes how the workers load every slice of source, without loading the slices themselves where possible
+    :param source: A DicomManager, or a list of image paths
+    :return: A list of (kind, payload) tasks, one per slice
+    """
+    if isinstance(source, DicomManager):
+        if source.lazy:
+            # Workers preprocess the raw slices themselves
+            kwargs = source.get_slice_kwargs()
+            return [("raw", (np.ascontiguousarray(s), kwargs)) for s in source.raw_imgs]
+        filename = getattr(source.imgs, "filename", None)
+        if filename is not None:
+            return [("npy", (filename, idx)) for idx in range(len(source.imgs))]
+        return [("array", s) for s in source.imgs]
+    return [("file", path) for path in source]
+
+
+def load_slice(kind, payload):
+    """
+    Loads a slice described by a task from slice_tasks
+    :return: The slice as a PIL image
+    """
+    if kind == "file":
+        return Image.open(payload)
+    if kind == "npy":
+        filename, idx = payload
+        if filename not in worker_volumes:
+            worker_volumes[filename] = np.load(filename, mmap_mode="r")
+        return Image.fromarray(np.asarray(worker_volumes[filename][idx]))
+    if kind == "raw":
+        raw, kwargs = payload
+        return Image.fromarray(preprocess_slice(raw, **kwargs))
+    return Image.fromarray(payload)
+
+
+def contour_slice(task):
+    """
+    Computes the contours of one slice in a worker process
+    :param task: A tuple (slice index, kind, payload, threshold value, ContouringEngine options)
+    :return: The slice index and the list of its contours, largest first
+    """
+    idx, kind, payload, thresh_val, options = task
+    key = tuple(sorted(options.items()))
+    if key not in worker_engines:
+        worker_engines[key] = ContouringEngine(**options)
+    engine = worker_engines[key]
+    engine.set_image(load_slice(kind, payload))
+    return idx, engine.contours(thresh_val)
+
+
+def contour_volume(
+    source, thresh_val=70, top_k=None, num_workers=None, chunksize=None, **options
+):
+    """
+    Computes the contours of every slice of source in a process pool
+    :param source: A DicomManager, or a list of image paths
+    :param thresh_val: The binary threshold value
+    :param top_k: The number of largest contours to keep per slice, or None to keep all
+    :param num_workers: The number of worker processes, defaults to the number of CPUs
+    :param chunksize: The number of slices sent to a worker at once, by default about four chunks per worker
+    :param options: Further ContouringEngine options, e.g. min_area or approximation
+    :return: A dict with the int32 points (M, 2) of all contours concatenated, the offsets (C + 1,) of each
+    contour into points, and the slice_idx (C,) and contour_idx (C,) of each contour
+    """
+    options["top_k"] = top_k
+    tasks = [
+        (idx, kind, payload, thresh_val, options)
+        for idx, (kind, payload) in enumerate(slice_tasks(source))
+    ]
+    num_workers = num_workers or os.cpu_count()
+    if chunksize is None:
+        chunksize = max(1, len(tasks) // (num_workers * 4))
+
+    points = []
+    lengths = []
+    slice_idx = []
+    contour_idx = []
+    with MP_CONTEXT.Pool(num_workers) as pool:
+        for idx, contours in pool.imap(contour_slice, tasks, chunksize=chunksize):
+            for cnt_idx, cnt in enumerate(contours):
+                points.append(cnt.reshape(-1, 2))
+                lengths.append(len(cnt))
+                slice_idx.append(idx)
+                contour_idx.append(cnt_idx)
+            if (idx + 1) % max(1, len(tasks) // 10) == 0:
+                logger.info("Contoured {}/{} slices".format(idx + 1, len(tasks)))
+
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return {
+        "points": (
+            np.concatenate(points).astype(np.int32)
+            if points
+            else np.zeros((0, 2), np.int32)
+        ),
+        "offsets": offsets,
+        "slice_idx": np.asarray(slice_idx, dtype=np.int32),
+        "contour_idx": np.asarray(contour_idx, dtype=np.int32),
+    }
+
+
+def save_contour_volume(path, contours, thresh_val, scaling_factor):
+    """
+    Appends the result of contour_volume to the contour archive at path, or writes it to a single compressed
+    .npz file if path ends with .npz
+    :param path: The path of the archive folder or output file
+    :param contours: The dict returned by contour_volume
+    :param thresh_val: The threshold value the contours were computed with
+    :param scaling_factor: The scaling factor of the slices
+    """
+    if path.endswith(".npz"):
+        np.savez_compressed(
+            path, thresh_val=thresh_val, scaling_factor=scaling_factor, **contours
+        )
+    else:
+        ContourArchive(path).append_volume(contours, thresh_val, scaling_factor)
+
+
+def image_paths(folder):
+    """
+    Lists the images in folder, in the order the canvas shows them
+    """
+    names = sorted(
+        name
+        for name in os.listdir(folder)
+        if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS
+        and not os.path.isdir(os.path.join(folder, name))
+    )
+    return [os.path.join(folder, name) for name in names]
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(
+        description="Computes the contours of every slice of a study"
+    )
+    parser.add_argument("folder", help="folder with DICOM data or images")
+    parser.add_argument("--thresh", type=int, default=70, help="binary threshold value")
+    parser.add_argument(
+        "--scale", type=int, default=4, help="scaling factor for DICOM data"
+    )
+    parser.add_argument(
+        "--top-k", type=int, default=None, help="largest contours kept per slice"
+    )
+    parser.add_argument(
+        "--min-area", type=float, default=0, help="minimum contour area in pixels"
+    )
+    parser.add_argument(
+        "--min-perimeter",
+        type=float,
+        default=0,
+        help="minimum contour perimeter in pixels",
+    )
+    parser.add_argument(
+        "--approx",
+        choices=sorted(APPROXIMATIONS),
+        default="none",
+        help="contour approximation, simple only keeps the end points of straight segments",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=None, help="number of worker processes"
+    )
+    parser.add_argument(
+        "--output",
+        default=None,
+        help="contour archive to append to, or a .npz file, defaults to the contours archive of the study",
+    )
+    args = parser.parse_args()
+
+    if len(glob(args.folder + "/*.dcm")) > 0:
+        dm = DicomManager(
+            args.folder, scaling_factor=args.scale, num_workers=args.workers
+        )
+        source = dm
+        output = args.output or os.path.join(dm.get_output_path(), ARCHIVE_NAME)
+    else:
+        source = image_paths(args.folder)
+        output = args.output or os.path.join(args.folder, ARCHIVE_NAME)
+
+    contours = contour_volume(
+        source,
+        args.thresh,
+        args.top_k,
+        args.workers,
+        min_area=args.min_area,
+        min_perimeter=args.min_perimeter,
+        approximation=APPROXIMATIONS[args.approx],
+    )
+    save_contour_volume(output, contours, args.thresh, args.scale)
+    logger.info(
+        "Wrote {} contours with {} points to {}".format(
+            len(contours["slice_idx"]), len(contours["points"]), output
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,6 @@
 import logging
 import os
+import threading
 
 import cv2
 import numpy as np
@@ -8,28 +9,148 @@ logger = logging.getLogger(__name__)
 logger.setLevel(10)
 
 
-def cnt_from_img(im, thresh_val=40):
-    npim = np.array(im.convert('RGB'))
-    npim = npim[:, :, ::-1].copy()
-
-    # Convert to greyscale
-    imgray = cv2.cvtColor(npim, cv2.COLOR_BGR2GRAY)
-
-    # Blur
-    blur = cv2.GaussianBlur(imgray, (5, 5), 0)
-
-    clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
-    cl1 = clahe.apply(blur)
-
-    # Thresholding
-    thresh, ret = cv2.threshold(cl1, thresh_val, 255, cv2.THRESH_BINARY)
-
-    # Get contours
-    im2, contours, hierarchy = cv2.findContours(ret, cv2.RETR_LIST, cv2.CHAIN_APPROX_NONE)
-
-    # Sort contours by area
-    contours = sorted(contours, key=cv2.contourArea, reverse=True)
-    return contours
+def cnt_from_img(im, thresh_val=40, **options):
+    return ContouringEngine(im, **options).contours(thresh_val)
+
+
+class ContouringEngine:
+    """
+    Computes contours of an image. The greyscale, blurred and CLAHE equalized intermediates are cached per
+    image, so changing the threshold only redoes the thresholding and the contour search. The contours are
+    cached per threshold as well, and thresholds that produce the same binary image share their contours.
+    """
+
+    def __init__(
+        self,
+        im=None,
+        clip_limit=2.0,
+        tile_grid_size=(8, 8),
+        top_k=None,
+        min_area=0,
+        min_perimeter=0,
+        approximation=cv2.CHAIN_APPROX_NONE,
+    ):
+        """
+        ContouringEngine constructor
+        :param im: The PIL image to contour, can be set later with set_image
+        :param clip_limit: The CLAHE clip limit
+        :param tile_grid_size: The CLAHE tile grid size
+        :param top_k: The number of largest contours to keep, or None to keep all
+        :param min_area: The minimum area of the contours to keep
+        :param min_perimeter: The minimum perimeter of the contours to keep
+        :param approximation: The OpenCV contour approximation method, e.g. cv2.CHAIN_APPROX_SIMPLE to only keep
+        the end points of straight segments
+        """
+        self.clahe = cv2.createCLAHE(clipLimit=clip_limit, tileGridSize=tile_grid_size)
+        self.top_k = top_k
+        self.min_area = min_area
+        self.min_perimeter = min_perimeter
+        self.approximation = approximation
+        self.image = None
+        self.equalized = None
+        self.next_intensity = None
+        self.contour_cache = {}
+        self.lock = threading.RLock()
+        if im is not None:
+            self.set_image(im)
+
+    def set_image(self, im):
+        """
+        Sets the image to contour, preparing the equalized image the thresholds are applied to
+        :param im: A PIL image
+        """
+        with self.lock:
+            if im is self.image:
+                return
+            self.image = im
+            self.contour_cache = {}
+
+            # Convert to greyscale
+            if im.mode == 'L':
+                imgray = np.asarray(im)
+            else:
+                imgray = cv2.cvtColor(np.asarray(im.convert('RGB')), cv2.COLOR_RGB2GRAY)
+
+            # Blur
+            blur = cv2.GaussianBlur(imgray, (5, 5), 0)
+
+            self.equalized = self.clahe.apply(blur)
+
+            # For every threshold from -1 to 255, the lowest intensity in the image above it
+            intensities = np.flatnonzero(np.bincount(self.equalized.ravel(), minlength=256))
+            self.next_intensity = np.append(intensities, 256)[
+                np.searchsorted(intensities, np.arange(-1, 256), side='right')
+            ]
+
+    def mask_key(self, thresh_val):
+        """
+        Identifies the binary image produced by a threshold. All thresholds between two consecutive intensities
+        of the image produce the same binary image, identified by the lowest intensity above the threshold.
+        :param thresh_val: The binary threshold value
+        :return: The lowest intensity above thresh_val, or 256 if there is none
+        """
+        thresh_idx = int(np.clip(np.floor(thresh_val), -1, 255)) + 1
+        return int(self.next_intensity[thresh_idx])
+
+    def contours(self, thresh_val=40):
+        """
+        Computes the contours of the current image
+        :param thresh_val: The binary threshold value
+        :return: The contours that pass the filters, sorted by area from largest to smallest
+        """
+        with self.lock:
+            key = self.mask_key(thresh_val)
+            contours = self.contour_cache.get(key)
+            if contours is not None:
+                return contours
+
+            # Thresholding
+            thresh, ret = cv2.threshold(self.equalized, thresh_val, 255, cv2.THRESH_BINARY)
+
+            # Get contours
+            # OpenCV 3 returns (image, contours, hierarchy), OpenCV 4 returns (contours, hierarchy)
+            contours = cv2.findContours(ret, cv2.RETR_LIST, self.approximation)[-2]
+
+            contours = self.select(contours)
+            self.contour_cache[key] = contours
+            return contours
+
+    def select(self, contours):
+        """
+        Filters contours by area and perimeter and keeps the top_k largest, without sorting the others
+        :param contours: The contours from cv2.findContours
+        :return: The selected contours, sorted by area from largest to smallest
+        """
+        areas = np.array([cv2.contourArea(cnt) for cnt in contours])
+        keep = np.arange(len(contours))
+        if self.min_area > 0:
+            keep = keep[areas[keep] >= self.min_area]
+        if self.min_perimeter > 0:
+            perimeters = np.array([cv2.arcLength(contours[i], True) for i in keep])
+            keep = keep[perimeters >= self.min_perimeter]
+        if self.top_k is not None and self.top_k < len(keep):
+            keep = keep[np.argpartition(-areas[keep], self.top_k - 1)[:self.top_k]]
+            keep.sort()
+
+        # Sort contours by area, ties keep the order they were found in
+        order = keep[np.argsort(-areas[keep], kind='stable')]
+        return [contours[i] for i in order]
+
+    def sweep(self, thresh_values, should_stop=None):
+        """
+        Computes the contours for a range of thresholds, running the contour search once per distinct binary
+        image. The results are cached, so later calls to contours for these thresholds are free. The lock is
+        only held for one threshold at a time, so other requests can run in between.
+        :param thresh_values: An iterable of binary threshold values
+        :param should_stop: Optional callable checked before every threshold, the sweep stops when it returns True
+        :return: A dict of the contours for each threshold value that was computed
+        """
+        results = {}
+        for thresh_val in thresh_values:
+            if should_stop is not None and should_stop():
+                break
+            results[thresh_val] = self.contours(thresh_val)
+        return results
 
 
 def img_with_contour(img, cnt):
@@ -46,5 +167,5 @@ def save_contour(cnt, width, height, path):
 
 
 def save_image(img, path):
-    if not os.path.exists(path):
+    if not os.path.exists(path + '.bmp'):
         cv2.imwrite(path + ".bmp", np.array(img))
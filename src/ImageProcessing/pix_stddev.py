@@ -1,33 +1,41 @@
-from multiprocessing.pool import ThreadPool
-
-import cv2
 import numpy as np
 
-
-def stddev_for_pix(x, y, std_arr, images):
-    std_arr[x, y] = np.std(images[:, x, y])
+from src.ImageProcessing.stack_stats import combine_moments, iter_image_chunks, read_stack
 
 
 def pix_int_stddev(image_stack, parallel=False):
+    """
+    Computes the standard deviation of every pixel over a stack of images
+    :param image_stack: A list of paths to greyscale images of the same size
+    :param parallel: Decode the images with a thread pool
+    :return: An array with the standard deviation of each pixel
+    """
     if not image_stack:
         print("image_stack is empty")
         return
 
-    # open images
-    images = []
-    for image in image_stack:
-        im = cv2.imread(image, 0)
-        images.append(im)
-
-    images = np.asarray(images)
-    l, w = np.shape(images[0])
-    stddev_arr = np.zeros(np.shape(images[0]))
-    if parallel:
-        p = ThreadPool(8)
-        args = [(x, y, stddev_arr, images) for x in range(0, l) for y in range(0, w)]
-        p.starmap(stddev_for_pix, args)
-    else:
-        for x in range(0,l):
-            for y in range(0,w):
-                stddev_for_pix(x, y, stddev_arr, images)
-    return stddev_arr
\ No newline at end of file
+    # open images straight into a single array
+    images = read_stack(image_stack, num_workers=8 if parallel else None)
+    return np.std(images, axis=0)
+
+
+def pix_int_stddev_streaming(image_stack, chunk_size=32, parallel=False):
+    """
+    Computes the standard deviation of every pixel over a stack of images, reading chunk_size images at a time.
+    The running mean and variance of the chunks are combined with Chan et al.'s update of Welford's algorithm,
+    so the stack never has to fit in memory.
+    :param image_stack: A list of paths to greyscale images of the same size
+    :param chunk_size: The number of images held in memory at once
+    :param parallel: Decode the images with a thread pool
+    :return: An array with the standard deviation of each pixel
+    """
+    if not image_stack:
+        raise ValueError("image_stack is empty")
+
+    count = 0
+    mean = None
+    m2 = None
+    for chunk in iter_image_chunks(image_stack, chunk_size, 8 if parallel else None):
+        count, mean, m2 = combine_moments(count, mean, m2, chunk.astype(np.float64))
+
+    return np.sqrt(m2 / count)
@@ -0,0 +1,87 @@
+"""
+Multi-resolution image pyramids for rendering a viewport of a large image at any zoom level
+"""
+import math
+
+import cv2
+import numpy as np
+
+
+class ImagePyramid:
+    """
+    Image pyramid where each level halves the size of the previous one. Levels are built on first use, and
+    rendering only converts the part of the best matching level that is visible in the viewport.
+    """
+
+    def __init__(self, arr):
+        """
+        ImagePyramid constructor
+        :param arr: The full resolution uint8 image, greyscale or RGB
+        """
+        self.levels = [np.asarray(arr)]
+
+    @property
+    def shape(self):
+        return self.levels[0].shape
+
+    def level(self, idx):
+        """
+        Gets a level of the pyramid, building it if needed
+        :param idx: The level, 0 is full resolution and every level halves the size
+        :return: The image at that level
+        """
+        while len(self.levels) <= idx:
+            prev = self.levels[-1]
+            if min(prev.shape[:2]) <= 1:
+                break
+            size = ((prev.shape[1] + 1) // 2, (prev.shape[0] + 1) // 2)
+            self.levels.append(cv2.resize(prev, size, interpolation=cv2.INTER_AREA))
+        return self.levels[min(idx, len(self.levels) - 1)]
+
+    def render(self, zoom, view_x, view_y, width, height):
+        """
+        Renders the part of the image visible in a viewport
+        :param zoom: The number of screen pixels per image pixel
+        :param view_x: The image x coordinate at the left edge of the viewport
+        :param view_y: The image y coordinate at the top edge of the viewport
+        :param width: The width of the viewport in screen pixels
+        :param height: The height of the viewport in screen pixels
+        :return: A (height, width) array with the visible part of the image, and black elsewhere
+        """
+        out = np.zeros((height, width) + self.shape[2:], dtype=self.levels[0].dtype)
+
+        # Use the smallest level that still has at least one pixel per screen pixel
+        level_idx = max(0, int(math.floor(math.log2(1.0 / zoom)))) if zoom < 1 else 0
+        level = self.level(level_idx)
+        scale = level.shape[1] / self.shape[1]
+        level_zoom = zoom / scale
+
+        # Visible region in level coordinates
+        x0 = max(0, int(math.floor(view_x * scale)))
+        y0 = max(0, int(math.floor(view_y * scale)))
+        x1 = min(level.shape[1], int(math.ceil((view_x + width / zoom) * scale)))
+        y1 = min(level.shape[0], int(math.ceil((view_y + height / zoom) * scale)))
+        if x1 <= x0 or y1 <= y0:
+            return out
+
+        # Screen position of the visible region
+        sx0 = int(round((x0 / scale - view_x) * zoom))
+        sy0 = int(round((y0 / scale - view_y) * zoom))
+        sx1 = int(round((x1 / scale - view_x) * zoom))
+        sy1 = int(round((y1 / scale - view_y) * zoom))
+        if sx1 <= sx0 or sy1 <= sy0:
+            return out
+
+        interpolation = cv2.INTER_NEAREST if level_zoom >= 1 else cv2.INTER_AREA
+        region = cv2.resize(
+            np.ascontiguousarray(level[y0:y1, x0:x1]),
+            (sx1 - sx0, sy1 - sy0),
+            interpolation=interpolation,
+        )
+
+        # Clip the region to the viewport
+        cx0, cy0 = max(sx0, 0), max(sy0, 0)
+        cx1, cy1 = min(sx1, width), min(sy1, height)
+        if cx1 > cx0 and cy1 > cy0:
+            out[cy0:cy1, cx0:cx1] = region[cy0 - sy0 : cy1 - sy0, cx0 - sx0 : cx1 - sx0]
+        return out
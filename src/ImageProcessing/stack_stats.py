@@ -0,0 +1,202 @@
+"""
+Per pixel statistics over stacks of greyscale images, e.g. variability maps over exported background images.
+Images are streamed from disk in chunks, so stacks do not have to fit in memory.
+"""
+from multiprocessing.pool import ThreadPool
+
+import cv2
+import numpy as np
+
+# Number of pixels whose histograms are accumulated at once when computing percentiles
+PERCENTILE_BLOCK = 1 << 16
+
+
+def read_image(path):
+    im = cv2.imread(path, 0)
+    if im is None:
+        raise IOError("Could not read image {}".format(path))
+    return im
+
+
+def iter_image_chunks(image_stack, chunk_size=32, num_workers=None):
+    """
+    Streams a stack of greyscale images from disk.
+    :param image_stack: A list of paths to greyscale images of the same size
+    :param chunk_size: The number of images read at once
+    :param num_workers: The number of threads decoding images, or None to decode serially
+    :return: A generator of arrays of up to chunk_size images stacked along the first axis. The array is reused
+    for the next chunk, so copy it if it needs to be kept
+    """
+    pool = ThreadPool(num_workers) if num_workers else None
+    try:
+        chunk = None
+        for start in range(0, len(image_stack), chunk_size):
+            paths = image_stack[start:start + chunk_size]
+            images = pool.imap(read_image, paths) if pool else map(read_image, paths)
+            for idx, im in enumerate(images):
+                if chunk is None:
+                    chunk = np.empty((chunk_size,) + im.shape, dtype=im.dtype)
+                chunk[idx] = im
+            yield chunk[:len(paths)]
+    finally:
+        if pool:
+            pool.terminate()
+
+
+def read_stack(image_stack, num_workers=None):
+    """
+    Reads a whole stack of greyscale images into a single preallocated array
+    :param image_stack: A list of paths to greyscale images of the same size
+    :param num_workers: The number of threads decoding images, or None to decode serially
+    :return: An array of the images stacked along the first axis
+    """
+    images = None
+    start = 0
+    for chunk in iter_image_chunks(image_stack, num_workers=num_workers):
+        if images is None:
+            images = np.empty((len(image_stack),) + chunk.shape[1:], dtype=chunk.dtype)
+        images[start:start + len(chunk)] = chunk
+        start += len(chunk)
+    return images
+
+
+class StackStatistics:
+    """
+    Accumulates per pixel count, mean, variance, min, max and, for 8-bit images, exact percentiles over a
+    stack of images added chunk by chunk.
+    """
+
+    def __init__(self, percentiles=()):
+        """
+        StackStatistics constructor
+        :param percentiles: The percentiles in [0, 100] to compute. Percentiles are computed from per pixel
+        histograms, which take 256 32-bit counters per pixel (256MB for 512x512 images)
+        """
+        self.percentiles = tuple(percentiles)
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+        self.min = None
+        self.max = None
+        self.histogram = None
+
+    def add(self, chunk):
+        """
+        Adds a chunk of images to the statistics
+        :param chunk: An array of images stacked along the first axis
+        """
+        if len(chunk) == 0:
+            return
+        if self.percentiles and chunk.dtype != np.uint8:
+            raise ValueError("Percentiles require 8-bit images")
+
+        chunk_min = chunk.min(axis=0)
+        chunk_max = chunk.max(axis=0)
+        if self.count == 0:
+            self.min = chunk_min
+            self.max = chunk_max
+        else:
+            np.minimum(self.min, chunk_min, out=self.min)
+            np.maximum(self.max, chunk_max, out=self.max)
+
+        if self.percentiles:
+            self.add_histogram(chunk)
+
+        self.count, self.mean, self.m2 = combine_moments(
+            self.count, self.mean, self.m2, chunk.astype(np.float64)
+        )
+
+    def add_histogram(self, chunk):
+        if self.histogram is None:
+            self.histogram = np.zeros((256,) + chunk.shape[1:], dtype=np.uint32)
+        flat_histogram = self.histogram.reshape(-1)
+        pixel_idx = np.arange(self.histogram[0].size)
+        for im in chunk:
+            # Each pixel occurs once per image, so the flat (value, pixel) indices are unique
+            flat_histogram[im.ravel().astype(np.intp) * pixel_idx.size + pixel_idx] += 1
+
+    def std(self):
+        return np.sqrt(self.m2 / self.count)
+
+    def percentile(self, q):
+        """
+        Computes an exact per pixel percentile from the histograms, interpolating linearly between the two
+        nearest ranks like np.percentile
+        :param q: The percentile in [0, 100]
+        :return: An array with the percentile of each pixel
+        """
+        if self.histogram is None:
+            raise ValueError("Percentiles were not requested")
+        rank = q / 100.0 * (self.count - 1)
+        lower = int(np.floor(rank))
+        upper = min(lower + 1, self.count - 1)
+
+        histogram = self.histogram.reshape(256, -1)
+        out = np.empty(histogram.shape[1], dtype=np.float64)
+        # Work through the pixels in blocks to bound the size of the cumulative histogram
+        for start in range(0, histogram.shape[1], PERCENTILE_BLOCK):
+            block = slice(start, start + PERCENTILE_BLOCK)
+            cumulative = np.cumsum(histogram[:, block], axis=0)
+            # The value at sorted position k is the first bin with more than k values at or below it
+            lower_val = np.argmax(cumulative > lower, axis=0)
+            upper_val = np.argmax(cumulative > upper, axis=0)
+            out[block] = lower_val + (upper_val - lower_val) * (rank - lower)
+        return out.reshape(self.histogram.shape[1:])
+
+    def result(self):
+        """
+        Gets the accumulated statistics
+        :return: A dict of per pixel maps with the keys count, mean, std, min, max and one percentile key per
+        requested percentile
+        """
+        result = {
+            "count": self.count,
+            "mean": self.mean,
+            "std": self.std(),
+            "min": self.min,
+            "max": self.max,
+        }
+        for q in self.percentiles:
+            result["percentile_{:g}".format(q)] = self.percentile(q)
+        return result
+
+
+def combine_moments(count, mean, m2, chunk):
+    """
+    Adds a chunk of images to the running per pixel mean and sum of squared deviations, using Chan et al.'s
+    update of Welford's algorithm
+    :param count: The number of images seen so far
+    :param mean: The running mean, or None if no images were seen
+    :param m2: The running sum of squared deviations from the mean, or None if no images were seen
+    :param chunk: An array of images stacked along the first axis
+    :return: The updated count, mean and m2
+    """
+    chunk_count = len(chunk)
+    chunk_mean = chunk.mean(axis=0)
+    chunk_m2 = ((chunk - chunk_mean) ** 2).sum(axis=0)
+    if mean is None:
+        return chunk_count, chunk_mean, chunk_m2
+
+    total = count + chunk_count
+    delta = chunk_mean - mean
+    mean = mean + delta * (chunk_count / total)
+    m2 = m2 + chunk_m2 + delta ** 2 * (count * chunk_count / total)
+    return total, mean, m2
+
+
+def stack_statistics(image_stack, percentiles=(), chunk_size=32, num_workers=None):
+    """
+    Computes per pixel statistics over a stack of greyscale images in one pass over the files.
+    :param image_stack: A list of paths to greyscale images of the same size
+    :param percentiles: The percentiles in [0, 100] to compute
+    :param chunk_size: The number of images held in memory at once
+    :param num_workers: The number of threads decoding images, or None to decode serially
+    :return: A dict of per pixel maps, see StackStatistics.result
+    """
+    if not image_stack:
+        raise ValueError("image_stack is empty")
+
+    stats = StackStatistics(percentiles)
+    for chunk in iter_image_chunks(image_stack, chunk_size, num_workers):
+        stats.add(chunk)
+    return stats.result()
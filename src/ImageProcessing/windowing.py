@@ -0,0 +1,109 @@
+"""
+Conversion of image data to 8-bit for display
+"""
+
+from collections import OrderedDict
+from functools import lru_cache
+
+import numpy as np
+
+
+def window_level(arr, low=0, high=255):
+    """
+    Maps the intensities in [low, high] linearly onto [0, 255], clipping values outside the window
+    :param arr: An image array of any numeric dtype
+    :param low: The intensity mapped to 0
+    :param high: The intensity mapped to 255
+    :return: The image as a uint8 array
+    """
+    if arr.dtype == np.uint8 and low == 0 and high == 255:
+        return arr
+
+    out = np.subtract(arr, low, dtype=np.float32)
+    out *= 255.0 / max(high - low, 1e-6)
+    np.clip(out, 0, 255, out=out)
+    out += 0.5
+    return out.astype(np.uint8)
+
+
+@lru_cache(maxsize=16)
+def window_lut(low, high, size):
+    """
+    Builds a lookup table for window_level over the intensities 0 to size - 1
+    :param low: The intensity mapped to 0
+    :param high: The intensity mapped to 255
+    :param size: The number of entries, 256 for uint8 and 65536 for uint16 images
+    :return: A read only uint8 array
+    """
+    lut = window_level(np.arange(size), low, high)
+    lut.flags.writeable = False
+    return lut
+
+
+def apply_window(arr, low=0, high=255):
+    """
+    Maps an image to uint8 with the window [low, high]. 8 and 16-bit images, which include the preprocessed
+    DICOM slices, take one lookup per pixel in a cached table, other dtypes are mapped arithmetically by
+    window_level.
+    :param arr: An image array
+    :param low: The intensity mapped to 0
+    :param high: The intensity mapped to 255
+    :return: The image as a uint8 array
+    """
+    if arr.dtype == np.uint8 and low == 0 and high == 255:
+        return arr
+    if arr.dtype == np.uint8 or arr.dtype == np.uint16:
+        return np.take(window_lut(low, high, np.iinfo(arr.dtype).max + 1), arr)
+    return window_level(arr, low, high)
+
+
+def window_presets(arr):
+    """
+    Derives window presets for a study from one of its images
+    :param arr: An image array
+    :return: A dict of named (low, high) windows
+    """
+    low, high = np.percentile(arr, (1, 99))
+    return OrderedDict(
+        [
+            ("default", (0, 255)),
+            ("auto", (float(low), float(max(high, low + 1)))),
+            ("full", (float(arr.min()), float(max(arr.max(), arr.min() + 1)))),
+        ]
+    )
+
+
+class WindowedSliceCache:
+    """
+    LRU cache of slices mapped to uint8, keyed by slice and window
+    """
+
+    def __init__(self, maxsize=32):
+        """
+        WindowedSliceCache constructor
+        :param maxsize: The number of windowed slices to keep
+        """
+        self.maxsize = maxsize
+        self.slices = OrderedDict()
+
+    def get(self, key, window, load):
+        """
+        Gets a windowed slice, computing it on a miss
+        :param key: Identifies the slice, e.g. its index
+        :param window: The (low, high) window
+        :param load: Callable returning the slice array for key
+        :return: The windowed uint8 slice
+        """
+        cache_key = (key, tuple(window))
+        arr = self.slices.get(cache_key)
+        if arr is None:
+            arr = apply_window(np.asarray(load()), *window)
+            self.slices[cache_key] = arr
+            while len(self.slices) > self.maxsize:
+                self.slices.popitem(last=False)
+        else:
+            self.slices.move_to_end(cache_key)
+        return arr
+
+    def clear(self):
+        self.slices.clear()
@@ -0,0 +1,183 @@
+"""
+Binary archive of the contours of a study.
+
+An archive is a folder with two flat files, so contours can be appended without rewriting anything and read back
+with memory maps:
+- points.i32: the x/y points of all contours as little endian int32 pairs, one contour after the other
+- index.bin: one INDEX_DTYPE record per contour with the position of its points and its metadata
+Records are appended after their points, so an interrupted append leaves at most unreferenced points behind.
+"""
+import os
+import threading
+
+import numpy as np
+
+# Name of the archive folder that exports and batch contouring write to
+ARCHIVE_NAME = 'contours'
+
+POINTS_NAME = 'points.i32'
+INDEX_NAME = 'index.bin'
+
+POINT_DTYPE = np.dtype('<i4')
+INDEX_DTYPE = np.dtype([
+    ('offset', '<i8'),
+    ('count', '<i4'),
+    ('slice', '<i4'),
+    ('contour', '<i4'),
+    ('thresh', '<i4'),
+    ('scale', '<i4'),
+])
+
+
+class ContourArchive:
+    """
+    Appendable contour archive with random access, see the module docstring for the layout.
+    """
+
+    def __init__(self, path):
+        """
+        Opens the archive at path, creating it if it does not exist
+        :param path: The folder of the archive
+        """
+        self.path = path
+        self.points_path = os.path.join(path, POINTS_NAME)
+        self.index_path = os.path.join(path, INDEX_NAME)
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        for file_path in (self.points_path, self.index_path):
+            if not os.path.exists(file_path):
+                open(file_path, 'ab').close()
+
+    @staticmethod
+    def is_archive(path):
+        return os.path.isfile(os.path.join(path, INDEX_NAME))
+
+    def __len__(self):
+        return os.path.getsize(self.index_path) // INDEX_DTYPE.itemsize
+
+    def append(self, contours, slice_idx, contour_idx, thresh, scale):
+        """
+        Appends contours to the archive
+        :param contours: A list of contours, arrays of x/y points in any shape OpenCV uses, e.g. (N, 1, 2)
+        :param slice_idx: The slice index of each contour, or one index for all
+        :param contour_idx: The index of each contour in its slice, or one index for all
+        :param thresh: The threshold value of each contour, or one value for all
+        :param scale: The scaling factor of each contour, or one value for all
+        """
+        points = [np.asarray(cnt).reshape(-1, 2) for cnt in contours]
+        counts = [len(p) for p in points]
+        points = np.concatenate(points) if points else np.zeros((0, 2))
+        self.append_points(points, counts, slice_idx, contour_idx, thresh, scale)
+
+    def append_volume(self, volume, thresh, scale):
+        """
+        Appends the result of batch_contouring.contour_volume
+        :param volume: A dict with points, offsets, slice_idx and contour_idx
+        :param thresh: The threshold value the contours were computed with
+        :param scale: The scaling factor of the slices
+        """
+        self.append_points(volume['points'], np.diff(volume['offsets']), volume['slice_idx'],
+                           volume['contour_idx'], thresh, scale)
+
+    def append_points(self, points, counts, slice_idx, contour_idx, thresh, scale):
+        """
+        Appends contours whose points are already concatenated
+        :param points: An (M, 2) array of the points of all contours
+        :param counts: The number of points of each contour
+        The other parameters are as for append
+        """
+        counts = np.asarray(counts, dtype=np.int64)
+        records = np.zeros(len(counts), dtype=INDEX_DTYPE)
+        records['count'] = counts
+        records['slice'] = slice_idx
+        records['contour'] = contour_idx
+        records['thresh'] = thresh
+        records['scale'] = scale
+
+        with self.lock:
+            with open(self.points_path, 'ab') as points_file:
+                start = points_file.tell() // (2 * POINT_DTYPE.itemsize)
+                records['offset'] = start + np.cumsum(counts) - counts
+                points_file.write(np.ascontiguousarray(points, dtype=POINT_DTYPE).tobytes())
+            with open(self.index_path, 'ab') as index_file:
+                index_file.write(records.tobytes())
+
+    def index(self):
+        """
+        Gets the records of all contours
+        :return: A read-only structured array with the INDEX_DTYPE fields
+        """
+        if len(self) == 0:
+            return np.zeros(0, dtype=INDEX_DTYPE)
+        return np.memmap(self.index_path, dtype=INDEX_DTYPE, mode='r', shape=(len(self),))
+
+    def points(self):
+        """
+        Gets the points of all contours
+        :return: A read-only (M, 2) int32 array
+        """
+        count = os.path.getsize(self.points_path) // (2 * POINT_DTYPE.itemsize)
+        if count == 0:
+            return np.zeros((0, 2), dtype=POINT_DTYPE)
+        return np.memmap(self.points_path, dtype=POINT_DTYPE, mode='r', shape=(count, 2))
+
+    def __getitem__(self, idx):
+        """
+        Reads a single contour
+        :param idx: The index of the contour in the archive
+        :return: An (N, 2) int32 array of its points
+        """
+        record = self.index()[idx]
+        return np.array(self.points()[record['offset']:record['offset'] + record['count']])
+
+    def select(self, slices=None, thresh=None, scale=None, contour=None):
+        """
+        Finds contours by their metadata
+        :param slices: A (first, last) range of slice indices, inclusive, or None for all slices
+        :param thresh: The threshold value, or None for any
+        :param scale: The scaling factor, or None for any
+        :param contour: The index of the contour in its slice, or None for any
+        :return: The indices of the matching contours in the archive
+        """
+        index = self.index()
+        mask = np.ones(len(index), dtype=bool)
+        if slices is not None:
+            mask &= (index['slice'] >= slices[0]) & (index['slice'] <= slices[1])
+        for field, value in (('thresh', thresh), ('scale', scale), ('contour', contour)):
+            if value is not None:
+                mask &= index[field] == value
+        return np.flatnonzero(mask)
+
+    def read(self, indices=None):
+        """
+        Reads contours into one array
+        :param indices: The indices of the contours to read, e.g. from select, or None for all
+        :return: A dict with the int32 points (M, 2) of the contours concatenated, the offsets (C + 1,) of each
+        contour into points, and the slice_idx, contour_idx, thresh and scale (C,) of each contour
+        """
+        index = self.index()
+        if indices is not None:
+            index = index[np.asarray(indices, dtype=np.intp)]
+        all_points = self.points()
+
+        offsets = np.zeros(len(index) + 1, dtype=np.int64)
+        np.cumsum(index['count'], out=offsets[1:])
+        # Gather the point ranges of all contours with a single fancy index
+        starts = np.repeat(index['offset'] - offsets[:-1], index['count'])
+        points = np.array(all_points[starts + np.arange(offsets[-1])])
+        return {
+            'points': points.reshape(-1, 2),
+            'offsets': offsets,
+            'slice_idx': np.array(index['slice']),
+            'contour_idx': np.array(index['contour']),
+            'thresh': np.array(index['thresh']),
+            'scale': np.array(index['scale']),
+        }
+
+    def to_npz(self, path, indices=None):
+        """
+        Writes contours to a single compressed .npz file with the arrays of read
+        :param path: The path of the output file
+        :param indices: The indices of the contours to write, or None for all
+        """
+        np.savez_compressed(path, **self.read(indices))
@@ -0,0 +1,153 @@
+"""
+SQLite index of the contour text files exported to a folder, so exports can be looked up by slice, threshold and
+scale without listing and parsing the folder.
+"""
+import os
+import re
+import sqlite3
+import threading
+
+# The catalog is kept in a folder of its own, so that the journal files SQLite creates and deletes on every write
+# do not change the modification time of the export folder
+CATALOG_FOLDER = 'catalog'
+CATALOG_NAME = 'contours.sqlite'
+
+CONTOUR_FILENAME_REGEX = re.compile(r'(\w+)-(\d+)-(\d+)-(\d+)-(\d+)\.txt$')
+
+
+class ContourCatalog:
+    """
+    Catalog of the exported contours of a folder. The catalog records the modification time of the folder, and
+    is brought up to date with the files in the folder whenever it is opened after the folder changed.
+    """
+
+    def __init__(self, folder):
+        """
+        Opens the catalog of folder, creating it if it does not exist
+        :param folder: The folder with the exported contours
+        """
+        self.folder = folder
+        os.makedirs(os.path.join(folder, CATALOG_FOLDER), exist_ok=True)
+        path = os.path.join(folder, CATALOG_FOLDER, CATALOG_NAME)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS contours ('
+                'name TEXT PRIMARY KEY, hash TEXT, scale INTEGER, image_idx INTEGER, contour_idx INTEGER, '
+                'thresh INTEGER)'
+            )
+            # Queries fix threshold and scale and ask for a range of slices
+            self.connection.execute(
+                'CREATE INDEX IF NOT EXISTS contours_thresh_scale_image '
+                'ON contours (thresh, scale, image_idx)'
+            )
+            self.connection.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER)')
+        self.refresh()
+
+    @staticmethod
+    def exists(folder):
+        """
+        Checks whether a folder has a contour catalog, without creating one
+        :param folder: The folder with the exported contours
+        """
+        return os.path.isfile(os.path.join(folder, CATALOG_FOLDER, CATALOG_NAME))
+
+    def add(self, name):
+        """
+        Adds an exported contour text file to the catalog
+        :param name: The file name of the text file in the folder
+        """
+        self.add_many([name])
+
+    def add_many(self, names):
+        rows = []
+        for name in names:
+            match = CONTOUR_FILENAME_REGEX.match(name)
+            if match is not None:
+                file_hash, scale, image_idx, contour_idx, thresh = match.groups()
+                rows.append((name, file_hash, int(scale), int(image_idx), int(contour_idx), int(thresh)))
+        with self.lock, self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO contours VALUES (?, ?, ?, ?, ?, ?)', rows)
+
+    def refresh(self):
+        """
+        Brings the catalog up to date with the folder, if the folder changed since the catalog was last synced
+        :return: True if the catalog was synced
+        """
+        mtime = os.stat(self.folder).st_mtime_ns
+        with self.lock:
+            row = self.connection.execute('SELECT value FROM meta WHERE key = ?', ('folder_mtime',)).fetchone()
+        if row is not None and row[0] == mtime:
+            return False
+        self.sync(mtime)
+        return True
+
+    def sync(self, mtime=None):
+        """
+        Adds the contour text files that are in the folder but not in the catalog, and removes the ones that are
+        no longer in the folder
+        :param mtime: The modification time of the folder, read before listing it
+        """
+        if mtime is None:
+            mtime = os.stat(self.folder).st_mtime_ns
+        names = set(name for name in os.listdir(self.folder) if CONTOUR_FILENAME_REGEX.match(name))
+        with self.lock:
+            catalogued = set(row[0] for row in self.connection.execute('SELECT name FROM contours'))
+        with self.lock, self.connection:
+            self.connection.executemany('DELETE FROM contours WHERE name = ?',
+                                        [(name,) for name in catalogued - names])
+        self.add_many(sorted(names - catalogued))
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', ('folder_mtime', mtime))
+
+    def rebuild(self):
+        """
+        Replaces the catalog with the contour text files currently in the folder
+        :return: The number of files in the catalog
+        """
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM contours')
+        self.sync()
+        return len(self)
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute('SELECT COUNT(*) FROM contours').fetchone()[0]
+
+    def query(self, slices=None, thresh=None, scale=None, contour=None):
+        """
+        Finds exported contours
+        :param slices: A (first, last) range of slice indices, inclusive, or None for all slices
+        :param thresh: The threshold value, or None for any
+        :param scale: The scaling factor, or None for any
+        :param contour: The index of the contour in its slice, or None for any
+        :return: A list of (name, hash, scale, image index, contour index, threshold value) tuples, ordered by name
+        """
+        conditions = []
+        params = []
+        for column, value in (('thresh', thresh), ('scale', scale), ('contour_idx', contour)):
+            if value is not None:
+                conditions.append('{} = ?'.format(column))
+                params.append(value)
+        if slices is not None:
+            conditions.append('image_idx BETWEEN ? AND ?')
+            params.extend(slices)
+
+        sql = 'SELECT name, hash, scale, image_idx, contour_idx, thresh FROM contours'
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY name'
+        with self.lock:
+            return self.connection.execute(sql, params).fetchall()
+
+    def paths(self, slices=None, thresh=None, scale=None, contour=None):
+        """
+        Finds the paths of exported contour text files, see query for the parameters
+        :return: A list of paths, ordered by file name
+        """
+        return [os.path.join(self.folder, row[0]) for row in self.query(slices, thresh, scale, contour)]
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,176 @@
+"""
+Measurements of exported contours in mm: area, perimeter and centroid of every contour, and the volume and
+surface area of the surface lofted through the largest contour of every slice.
+
+Usage: python -m src.PostProcessing.contour_measurements <export folder or archive> [--thresh 70] [--scale 4]
+[--output report.json or report.csv]
+
+The report is written to measurements.json in the current directory by default, outside the export folder.
+"""
+import argparse
+import csv
+import json
+import os
+
+import numpy as np
+
+from src.DicomProcessing.DicomManager import contour_spacing
+from src.DicomProcessing.VolumeCache import VolumeCache
+from src.PostProcessing.contour_processing import load_contours
+from src.PostProcessing.surface_mesh import (contour_ids, mesh_from_contours, next_points, signed_areas,
+                                             signed_volume, surface_area)
+
+
+def spacing_from_export_folder(path, scaling_factor):
+    """
+    Find the voxel spacing of the study a folder of exported contours or a contour archive belongs to. The
+    spacing is stored with the cached raw volume of the study.
+    :param path: The export folder (saved_dicom_imgs) or an archive folder within it
+    :param scaling_factor: The scaling factor of the contours
+    :return: The (x, y, slice) size in mm of a unit in contour coordinates, or None if it is not known
+    """
+    for folder in (path, os.path.dirname(os.path.normpath(path))):
+        spacing = VolumeCache(os.path.join(folder, 'cache')).read_spacing()
+        if spacing is not None:
+            return contour_spacing(spacing, scaling_factor)
+    return None
+
+
+def measure_contours(xy, offsets, slice_idx, spacing):
+    """
+    Measure every contour
+    :param xy: The (M, 2) points of all contours in contour coordinates
+    :param offsets: The offsets (C + 1,) of each contour into the points
+    :param slice_idx: The slice index (C,) of each contour
+    :param spacing: The (x, y, slice) size in mm of a unit in contour coordinates
+    :return: A dict of (C,) arrays: slice, area, perimeter, centroid_x, centroid_y and centroid_z, in mm
+    """
+    xy = np.asarray(xy, dtype=np.float64) * spacing[:2]
+    ids = contour_ids(offsets)
+    counts = np.diff(offsets)
+    nxt = next_points(offsets)
+
+    areas = signed_areas(xy, offsets)
+    perimeters = np.bincount(ids, weights=np.linalg.norm(xy[nxt] - xy, axis=1), minlength=len(counts))
+
+    # Polygon centroid, falling back to the mean of the points for contours without area
+    cross = xy[:, 0] * xy[nxt, 1] - xy[nxt, 0] * xy[:, 1]
+    centroid = np.empty((len(counts), 2))
+    for dim in range(2):
+        moment = np.bincount(ids, weights=(xy[:, dim] + xy[nxt, dim]) * cross, minlength=len(counts))
+        mean = np.bincount(ids, weights=xy[:, dim], minlength=len(counts)) / np.maximum(counts, 1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            centroid[:, dim] = np.where(areas != 0, moment / (6 * areas), mean)
+
+    return {
+        'slice': np.asarray(slice_idx),
+        'area': np.abs(areas),
+        'perimeter': perimeters,
+        'centroid_x': centroid[:, 0],
+        'centroid_y': centroid[:, 1],
+        'centroid_z': np.asarray(slice_idx) * spacing[2],
+    }
+
+
+def measure_volume(xy, offsets, slice_idx, spacing, num_points=128):
+    """
+    Measure the volume and surface area of the surface lofted through the largest contour of every slice
+    :param xy: The (M, 2) points of all contours in contour coordinates
+    :param offsets: The offsets (C + 1,) of each contour into the points
+    :param slice_idx: The slice index (C,) of each contour
+    :param spacing: The (x, y, slice) size in mm of a unit in contour coordinates
+    :param num_points: The number of points every ring is resampled to
+    :return: The volume in mm^3 and surface area in mm^2
+    """
+    points = np.empty((len(xy), 3))
+    points[:, 0] = xy[:, 0] * spacing[0]
+    points[:, 1] = np.repeat(np.asarray(slice_idx) * spacing[2], np.diff(offsets))
+    points[:, 2] = xy[:, 1] * spacing[1]
+    vertices, faces = mesh_from_contours(points, offsets, slice_idx, num_points)
+    return signed_volume(vertices, faces), surface_area(vertices, faces)
+
+
+def measurement_report(path, thresh=None, scale=4, spacing=None):
+    """
+    Measure all contours of a folder of exported contours or a contour archive
+    :param path: The export folder or archive folder
+    :param thresh: Only measure contours with this threshold value, or None for all
+    :param scale: The scaling factor of the contours to measure
+    :param spacing: The (x, y, slice) size in mm of a unit in contour coordinates, by default read from the
+    cache of the study
+    :return: A dict with the spacing, the number of contours and slices, the volume and surface area, and a list
+    of per contour measurements
+    """
+    if spacing is None:
+        spacing = spacing_from_export_folder(path, scale)
+        if spacing is None:
+            raise ValueError('The voxel spacing of {} is not known, pass it explicitly'.format(path))
+    spacing = np.asarray(spacing, dtype=np.float64)
+
+    points, offsets, slice_idx = load_contours(path, voxel_width=1, thresh=thresh, scale=scale)
+    xy = points[:, [0, 2]]
+    contours = measure_contours(xy, offsets, slice_idx, spacing)
+    num_slices = len(np.unique(slice_idx))
+    volume, area = measure_volume(xy, offsets, slice_idx, spacing) if num_slices >= 2 else (0.0, 0.0)
+
+    names = list(contours)
+    return {
+        'spacing': spacing.tolist(),
+        'num_contours': len(slice_idx),
+        'num_slices': num_slices,
+        'volume': float(volume),
+        'surface_area': float(area),
+        'contours': [dict(zip(names, row)) for row in zip(*(contours[name].tolist() for name in names))],
+    }
+
+
+def summary_path(path):
+    """
+    Get the path of the summary written next to a CSV report
+    :param path: The path of the CSV report
+    :return: The path of the JSON summary, e.g. report_summary.json for report.csv
+    """
+    return os.path.splitext(path)[0] + '_summary.json'
+
+
+def write_report(report, path):
+    """
+    Write a measurement report as JSON. If path ends with .csv, the per contour measurements are written as CSV
+    and the rest of the report, i.e. the spacing, counts, volume and surface area, to a JSON summary next to it,
+    see summary_path.
+    :param report: The dict returned by measurement_report
+    :param path: The path of the report
+    """
+    if not path.endswith('.csv'):
+        with open(path, 'w') as report_file:
+            json.dump(report, report_file, indent=2)
+        return
+
+    with open(path, 'w', newline='') as report_file:
+        writer = csv.DictWriter(report_file, fieldnames=list(report['contours'][0]) if report['contours'] else [])
+        writer.writeheader()
+        writer.writerows(report['contours'])
+    with open(summary_path(path), 'w') as summary_file:
+        json.dump({key: value for key, value in report.items() if key != 'contours'}, summary_file, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measures the exported contours of a study')
+    parser.add_argument('folder', help='export folder or contour archive')
+    parser.add_argument('--thresh', type=int, default=None, help='threshold value of the contours to measure')
+    parser.add_argument('--scale', type=int, default=4, help='scaling factor of the contours to measure')
+    parser.add_argument('--spacing', type=float, nargs=3, default=None, metavar=('X', 'Y', 'SLICE'),
+                        help='size in mm of a unit in contour coordinates, read from the study cache by default')
+    parser.add_argument('--output', default='measurements.json',
+                        help='JSON report, or CSV of the per contour measurements with the totals in a '
+                             '<name>_summary.json next to it')
+    args = parser.parse_args()
+
+    report = measurement_report(args.folder, args.thresh, args.scale, args.spacing)
+    write_report(report, args.output)
+    print('{} contours on {} slices, volume {:.1f} mm^3, surface area {:.1f} mm^2, written to {}'.format(
+        report['num_contours'], report['num_slices'], report['volume'], report['surface_area'], args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -3,9 +3,15 @@ Miscellaneous post-processing scripts for contours and images
 """
 import os
 import numpy as np
-import re
+from multiprocessing.pool import ThreadPool
 import matplotlib.pyplot as plt
 
+from src.PostProcessing.contour_archive import ContourArchive
+from src.PostProcessing.contour_catalog import CONTOUR_FILENAME_REGEX, ContourCatalog
+
+# Blanks out the brackets and commas of np.array2string output, leaving whitespace separated integers
+CONTOUR_TEXT_TABLE = bytes.maketrans(b'[],', b'   ')
+
 
 def text_files_from_folder(folder_path):
     """
@@ -22,39 +28,85 @@ def text_files_from_folder(folder_path):
     return contour_filenames
 
 
-def contours_from_files(folder_path, voxel_width = 0.8):
+def read_contour_text(path):
     """
-    Extract contours from text files in a folder
-    :param folder_path: The folder with the contour text files
-    :param contour_filenames: The names of the contour files
-    :return: An array of the retrieved contours
-    """
-    global file
-    contour_filenames = text_files_from_folder(folder_path)
-    regexp = r'\[([0-9]+), ([0-9]+)\]'
-    slice_num_reg = r'(\w+)-(\d+)-(\d+)-(\d+)-(\d+)'
-    slice_width = voxel_width
-    file_dict = {}
-    contour_arrs = []
-    for file in contour_filenames:
-        slice_num = int(re.findall(slice_num_reg, file)[0][2])
-        z = slice_num * slice_width
-        if file_dict.get(slice_num) is None:
-            file_dict[slice_num] = [file]
+    Read the points of an exported contour text file
+    :param path: The path of the text file
+    :return: An (N, 2) int32 array of the x/y points, or None if the file does not exist
+    """
+    try:
+        with open(path, 'rb') as contour_file:
+            data = contour_file.read().translate(CONTOUR_TEXT_TABLE)
+    except FileNotFoundError:
+        return None
+    return np.fromstring(data, dtype=np.int32, sep=' ').reshape(-1, 2)
+
+
+def load_contours(path, voxel_width=0.8, slices=None, thresh=None, scale=None, num_workers=8):
+    """
+    Load all contours of a folder of exported contour text files, or of a contour archive, into one array. The
+    text files are looked up in the contour catalog of the folder if it has one, and listed otherwise.
+    :param path: The folder with the contour text files, or a contour archive folder
+    :param voxel_width: The distance between slices
+    :param slices: Only load contours of this (first, last) range of slice indices, or None for all
+    :param thresh: Only load contours with this threshold value, or None for all
+    :param scale: Only load contours with this scaling factor, or None for all
+    :param num_workers: The number of threads reading text files
+    :return: The (M, 3) points of all contours concatenated, with the slice position in the second column, the
+    offsets (C + 1,) of each contour into the points, and the slice index (C,) of each contour
+    """
+    if ContourArchive.is_archive(path):
+        archive = ContourArchive(path)
+        contours = archive.read(archive.select(slices, thresh, scale))
+        xy = contours['points']
+        offsets = contours['offsets']
+        slice_idx = contours['slice_idx']
+    else:
+        if ContourCatalog.exists(path):
+            catalog = ContourCatalog(path)
+            rows = catalog.query(slices, thresh, scale)
+            catalog.close()
+            names = [row[0] for row in rows]
+            slice_idx = [row[3] for row in rows]
         else:
-            file_dict[slice_num].append(file)
-        full_path = os.path.join(folder_path, file)
-        with open(full_path, 'r') as contour_file:
-            file_arr = np.fromregex(contour_file, regexp, dtype=[('num1', np.float64), ('num2', np.float64)])
+            names = []
+            slice_idx = []
+            for file in text_files_from_folder(path):
+                match = CONTOUR_FILENAME_REGEX.match(file)
+                if match is None:
+                    continue
+                file_scale, file_slice, _, file_thresh = map(int, match.groups()[1:])
+                if ((slices is None or slices[0] <= file_slice <= slices[1]) and
+                        (thresh is None or file_thresh == thresh) and (scale is None or file_scale == scale)):
+                    names.append(file)
+                    slice_idx.append(file_slice)
 
-        arr = np.zeros((len(file_arr), 3))
-        for idx, pair in enumerate(file_arr):
-            arr[idx][0] = pair[0]
-            arr[idx][2] = pair[1]
-            arr[idx][1] = z
-        contour_arrs.append(arr)
+        with ThreadPool(num_workers) as pool:
+            file_points = pool.map(read_contour_text, [os.path.join(path, name) for name in names])
+        # Skip files that were removed since the catalog was synced
+        slice_idx = [idx for idx, p in zip(slice_idx, file_points) if p is not None]
+        file_points = [p for p in file_points if p is not None]
+        offsets = np.zeros(len(file_points) + 1, dtype=np.int64)
+        np.cumsum([len(p) for p in file_points], out=offsets[1:])
+        xy = np.concatenate(file_points) if file_points else np.zeros((0, 2), dtype=np.int32)
+        slice_idx = np.array(slice_idx, dtype=np.int32)
 
-    return contour_arrs
+    points = np.empty((len(xy), 3))
+    points[:, 0] = xy[:, 0]
+    points[:, 1] = np.repeat(slice_idx * voxel_width, np.diff(offsets))
+    points[:, 2] = xy[:, 1]
+    return points, offsets, slice_idx
+
+
+def contours_from_files(folder_path, voxel_width = 0.8):
+    """
+    Extract contours from text files in a folder
+    :param folder_path: The folder with the contour text files, or a contour archive folder
+    :param voxel_width: The distance between slices
+    :return: A list with an (N, 3) array per contour
+    """
+    points, offsets, _ = load_contours(folder_path, voxel_width)
+    return np.split(points, offsets[1:-1])
 
 
 def plot_from_contours(contour_arrs):
@@ -65,6 +117,25 @@ def plot_from_contours(contour_arrs):
     plt.show()
 
 
+def format_vertices(points):
+    """
+    Format points as OBJ vertex lines with a single string formatting operation
+    :param points: An (N, 3) array of points
+    :return: The vertex lines
+    """
+    return ('v %.5f %.5f %.5f\n' * len(points)) % tuple(np.asarray(points, dtype=np.float64).ravel())
+
+
+def format_polyline(first, last):
+    """
+    Format an OBJ polyline through consecutive vertices
+    :param first: The 1-based index of the first vertex
+    :param last: The 1-based index of the last vertex
+    :return: The polyline line
+    """
+    return 'l ' + ' '.join(map(str, range(first, last + 1))) + '\n'
+
+
 def obj_from_contour(contour, name):
     """
     Write a contour out to an object file. Useful for visualization in Blender
@@ -72,14 +143,69 @@ def obj_from_contour(contour, name):
     :param name: The name of the contour to output
     """
     with open(name, 'w') as obj_file:
-        vertex_idx = 0
         obj_file.write('o ' + name + '\n')
-        for (x, y, z) in contour:
-            obj_file.write("v %.5f %.5f %.5f\n" % (x, y, z))
-            vertex_idx += 1
-
-        polyline = 'l '
-        for i in range(1, vertex_idx):
-            polyline += '{} '.format(i)
-        polyline += '\n'
-        obj_file.write(polyline)
+        obj_file.write(format_vertices(contour))
+        obj_file.write(format_polyline(1, len(contour)))
+
+
+def sort_by_slice(points, offsets, slice_idx):
+    """
+    Reorder contours by slice index, keeping the order of the contours within a slice
+    :return: The reordered points, offsets and slice indices
+    """
+    order = np.argsort(slice_idx, kind='stable')
+    counts = np.diff(offsets)[order]
+    sorted_offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=sorted_offsets[1:])
+    starts = np.repeat(offsets[:-1][order] - sorted_offsets[:-1], counts)
+    return points[starts + np.arange(sorted_offsets[-1])], sorted_offsets, np.asarray(slice_idx)[order]
+
+
+def obj_from_contours(points, offsets, slice_idx, path):
+    """
+    Write all contours of a study to a single object file, with one object per slice and one polyline per
+    contour. Useful for visualization in Blender
+    :param points: The (M, 3) points of all contours, as returned by load_contours
+    :param offsets: The offsets (C + 1,) of each contour into points
+    :param slice_idx: The slice index (C,) of each contour
+    :param path: The path of the object file
+    """
+    points, offsets, slice_idx = sort_by_slice(points, offsets, slice_idx)
+    slices, firsts = np.unique(slice_idx, return_index=True)
+    lasts = np.append(firsts[1:], len(slice_idx))
+    with open(path, 'w') as obj_file:
+        for slice_num, first, last in zip(slices, firsts, lasts):
+            obj_file.write('o slice_{}\n'.format(slice_num))
+            obj_file.write(format_vertices(points[offsets[first]:offsets[last]]))
+            obj_file.write(''.join(format_polyline(offsets[i] + 1, offsets[i + 1]) for i in range(first, last)
+                                   if offsets[i + 1] - offsets[i] > 1))
+
+
+def ply_from_contours(points, offsets, path):
+    """
+    Write all contours of a study to a single binary PLY file, with the contours as chains of edges
+    :param points: The (M, 3) points of all contours, as returned by load_contours
+    :param offsets: The offsets (C + 1,) of each contour into points
+    :param path: The path of the PLY file
+    """
+    # Connect every point to the next one, except for the last point of each contour
+    is_edge = np.ones(max(len(points) - 1, 0), dtype=bool)
+    ends = offsets[1:-1] - 1
+    is_edge[ends[(ends >= 0) & (ends < len(is_edge))]] = False
+    starts = np.flatnonzero(is_edge)
+    edges = np.stack([starts, starts + 1], axis=1).astype('<i4')
+
+    header = ('ply\n'
+              'format binary_little_endian 1.0\n'
+              'element vertex {}\n'
+              'property float x\n'
+              'property float y\n'
+              'property float z\n'
+              'element edge {}\n'
+              'property int vertex1\n'
+              'property int vertex2\n'
+              'end_header\n').format(len(points), len(edges))
+    with open(path, 'wb') as ply_file:
+        ply_file.write(header.encode('ascii'))
+        ply_file.write(np.asarray(points, dtype='<f4').tobytes())
+        ply_file.write(edges.tobytes())
@@ -0,0 +1,212 @@
+"""
+Surface reconstruction from stacked slice contours.
+
+The largest contour of each slice is resampled to the same number of points by arc length, the rings are given
+the same orientation and rotated so that their starting points line up, and consecutive rings are joined by
+triangle strips. Both ends are closed with a fan around the centroid of the ring, so the mesh is watertight.
+"""
+import numpy as np
+
+from src.PostProcessing.contour_processing import format_vertices
+
+
+def contour_ids(offsets):
+    """
+    Get the index of the contour of every point
+    :param offsets: The offsets (C + 1,) of each contour into the points
+    :return: An (M,) array of contour indices
+    """
+    return np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+
+
+def next_points(offsets):
+    """
+    Get the index of the next point along its contour of every point, wrapping around at the end of the contour
+    :param offsets: The offsets (C + 1,) of each contour into the points
+    :return: An (M,) array of point indices
+    """
+    nxt = np.arange(1, offsets[-1] + 1)
+    counts = np.diff(offsets)
+    nxt[offsets[1:][counts > 0] - 1] = offsets[:-1][counts > 0]
+    return nxt
+
+
+def signed_areas(xy, offsets):
+    """
+    Compute the signed area of every contour with the shoelace formula, positive for counterclockwise contours
+    :param xy: The (M, 2) points of all contours
+    :param offsets: The offsets (C + 1,) of each contour into the points
+    :return: A (C,) array of signed areas
+    """
+    nxt = next_points(offsets)
+    cross = xy[:, 0] * xy[nxt, 1] - xy[nxt, 0] * xy[:, 1]
+    return 0.5 * np.bincount(contour_ids(offsets), weights=cross, minlength=len(offsets) - 1)
+
+
+def largest_contours(points, offsets, slice_idx):
+    """
+    Pick the contour with the largest area of every slice
+    :param points: The (M, 3) points of all contours, as returned by load_contours
+    :param offsets: The offsets (C + 1,) of each contour into points
+    :param slice_idx: The slice index (C,) of each contour
+    :return: The indices of the picked contours, ordered by slice index
+    """
+    areas = np.abs(signed_areas(points[:, [0, 2]], offsets))
+    # Sort by slice, then by decreasing area, and keep the first contour of every slice
+    order = np.lexsort((-areas, slice_idx))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = np.diff(np.asarray(slice_idx)[order]) != 0
+    picked = order[first]
+    return picked[np.diff(offsets)[picked] >= 3]
+
+
+def resample_ring(ring, num_points):
+    """
+    Resample a closed ring to points spaced equally along its perimeter
+    :param ring: The (N, D) points of the ring
+    :param num_points: The number of points to resample to
+    :return: A (num_points, D) array
+    """
+    closed = np.vstack([ring, ring[:1]])
+    lengths = np.linalg.norm(np.diff(closed, axis=0), axis=1)
+    distance = np.concatenate(([0], np.cumsum(lengths)))
+    targets = np.linspace(0, distance[-1], num_points, endpoint=False)
+    return np.stack([np.interp(targets, distance, closed[:, dim]) for dim in range(ring.shape[1])], axis=1)
+
+
+def align_ring(ring, previous):
+    """
+    Rotate the starting point of a ring so that it lines up best with the previous ring, i.e. the sum of squared
+    distances between corresponding points is smallest. All shifts are scored at once with an FFT correlation.
+    :param ring: The (N, 2) points of the ring
+    :param previous: The (N, 2) points of the previous ring
+    :return: The rotated ring
+    """
+    correlation = np.fft.ifft(np.conj(np.fft.fft(previous, axis=0)) * np.fft.fft(ring, axis=0), axis=0)
+    shift = np.argmax(correlation.real.sum(axis=1))
+    return np.roll(ring, -shift, axis=0)
+
+
+def loft_rings(rings, positions):
+    """
+    Build a watertight triangle mesh through rings of equal length
+    :param rings: A (K, N, 2) array of rings in the slice plane
+    :param positions: The (K,) positions of the rings along the slice axis
+    :return: The (K * N + 2, 3) vertices and (F, 3) triangles of the mesh
+    """
+    num_rings, num_points = rings.shape[:2]
+    vertices = np.empty((num_rings, num_points, 3))
+    vertices[:, :, 0] = rings[:, :, 0]
+    vertices[:, :, 1] = np.asarray(positions)[:, None]
+    vertices[:, :, 2] = rings[:, :, 1]
+    vertices = vertices.reshape(-1, 3)
+    caps = np.stack([vertices[:num_points].mean(axis=0), vertices[-num_points:].mean(axis=0)])
+    vertices = np.vstack([vertices, caps])
+
+    # Two triangles for every quad between point i and i + 1 of ring k and ring k + 1
+    ring_start = (np.arange(num_rings - 1) * num_points)[:, None]
+    i = np.arange(num_points)[None, :]
+    j = (i + 1) % num_points
+    a = (ring_start + i).ravel()
+    b = (ring_start + j).ravel()
+    c = b + num_points
+    d = a + num_points
+    strips = np.concatenate([np.stack([a, b, c], axis=1), np.stack([a, c, d], axis=1)])
+
+    i = np.arange(num_points)
+    j = (i + 1) % num_points
+    first_cap = np.stack([np.full(num_points, num_rings * num_points), j, i], axis=1)
+    last_start = (num_rings - 1) * num_points
+    last_cap = np.stack([np.full(num_points, num_rings * num_points + 1), last_start + i, last_start + j], axis=1)
+    faces = np.concatenate([strips, first_cap, last_cap])
+
+    # Point the normals outwards, which makes the signed volume positive
+    if signed_volume(vertices, faces) < 0:
+        faces = faces[:, ::-1]
+    return vertices, faces
+
+
+def signed_volume(vertices, faces):
+    """
+    Compute the signed volume enclosed by a closed triangle mesh with the divergence theorem
+    :param vertices: The (V, 3) vertices
+    :param faces: The (F, 3) triangles
+    :return: The volume, positive if the normals point outwards
+    """
+    a, b, c = (vertices[faces[:, k]] for k in range(3))
+    return np.einsum('ij,ij->', a, np.cross(b, c)) / 6
+
+
+def surface_area(vertices, faces):
+    """
+    Compute the area of a triangle mesh
+    :param vertices: The (V, 3) vertices
+    :param faces: The (F, 3) triangles
+    :return: The area
+    """
+    a, b, c = (vertices[faces[:, k]] for k in range(3))
+    return 0.5 * np.linalg.norm(np.cross(b - a, c - a), axis=1).sum()
+
+
+def mesh_from_contours(points, offsets, slice_idx, num_points=128):
+    """
+    Loft the largest contour of every slice into a watertight triangle mesh
+    :param points: The (M, 3) points of all contours, as returned by load_contours
+    :param offsets: The offsets (C + 1,) of each contour into points
+    :param slice_idx: The slice index (C,) of each contour
+    :param num_points: The number of points every ring is resampled to
+    :return: The (V, 3) vertices and (F, 3) triangles of the mesh
+    """
+    picked = largest_contours(points, offsets, slice_idx)
+    if len(picked) < 2:
+        raise ValueError('At least two slices with contours are needed for a surface')
+
+    rings = np.empty((len(picked), num_points, 2))
+    for k, idx in enumerate(picked):
+        xy = points[offsets[idx]:offsets[idx + 1]][:, [0, 2]]
+        ring = resample_ring(xy, num_points)
+        if signed_areas(ring, np.array([0, num_points]))[0] < 0:
+            ring = ring[::-1]
+        rings[k] = ring if k == 0 else align_ring(ring, rings[k - 1])
+
+    positions = points[offsets[picked], 1]
+    return loft_rings(rings, positions)
+
+
+def write_obj(vertices, faces, path, name='surface'):
+    """
+    Write a triangle mesh to an object file
+    :param vertices: The (V, 3) vertices
+    :param faces: The (F, 3) triangles
+    :param path: The path of the object file
+    :param name: The name of the object
+    """
+    with open(path, 'w') as obj_file:
+        obj_file.write('o {}\n'.format(name))
+        obj_file.write(format_vertices(vertices))
+        obj_file.write(('f %d %d %d\n' * len(faces)) % tuple((faces + 1).ravel()))
+
+
+def write_ply(vertices, faces, path):
+    """
+    Write a triangle mesh to a binary PLY file
+    :param vertices: The (V, 3) vertices
+    :param faces: The (F, 3) triangles
+    :param path: The path of the PLY file
+    """
+    header = ('ply\n'
+              'format binary_little_endian 1.0\n'
+              'element vertex {}\n'
+              'property float x\n'
+              'property float y\n'
+              'property float z\n'
+              'element face {}\n'
+              'property list uchar int vertex_indices\n'
+              'end_header\n').format(len(vertices), len(faces))
+    face_records = np.empty(len(faces), dtype=[('count', 'u1'), ('indices', '<i4', (3,))])
+    face_records['count'] = 3
+    face_records['indices'] = faces
+    with open(path, 'wb') as ply_file:
+        ply_file.write(header.encode('ascii'))
+        ply_file.write(np.asarray(vertices, dtype='<f4').tobytes())
+        ply_file.write(face_records.tobytes())
@@ -0,0 +1,161 @@
+import hashlib
+import logging
+import os
+import queue
+import sys
+import threading
+
+import numpy as np
+
+from src.ImageProcessing.contouring import save_contour, save_image
+from src.PostProcessing.contour_archive import ARCHIVE_NAME, ContourArchive
+from src.PostProcessing.contour_catalog import ContourCatalog
+
+
+class ContourExporter:
+    """
+    Writes exported contours on a fixed number of background threads, so exporting does not block the Tk loop.
+    Exports wait in a bounded queue, so a burst of exports blocks the caller instead of growing without limit.
+    Background images are named by their content, so each distinct background of a slice is written only once.
+    Contours are also appended to the contour archive and added to the contour catalog of the export folder.
+    """
+
+    def __init__(self, num_workers=2, max_pending=64):
+        """
+        ContourExporter constructor
+        :param num_workers: The number of writer threads
+        :param max_pending: The number of exports that can wait in the queue before export blocks
+        """
+        self.logger = logging.getLogger(__name__)
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.lock = threading.Lock()
+        self.written_backgrounds = set()
+        self.archives = {}
+        self.catalogs = {}
+        self.failed = 0
+
+        self.threads = [
+            threading.Thread(target=self.run, daemon=True) for _ in range(num_workers)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def export(
+        self,
+        contour,
+        width,
+        height,
+        image,
+        folder,
+        file_hash,
+        scale,
+        slice_idx,
+        contour_idx,
+        thresh,
+    ):
+        """
+        Queues a contour for writing
+        :param contour: The contour to write
+        :param width: The width of the contour image
+        :param height: The height of the contour image
+        :param image: The background Image of the contour, it must not be modified afterwards
+        :param folder: The folder to write to
+        :param file_hash: The hash that starts the file names of the export
+        :param scale: The scaling factor of the slice
+        :param slice_idx: The index of the slice
+        :param contour_idx: The index of the contour in the slice
+        :param thresh: The threshold value the contour was computed with
+        """
+        self.queue.put(
+            (
+                contour,
+                width,
+                height,
+                image,
+                folder,
+                file_hash,
+                scale,
+                slice_idx,
+                contour_idx,
+                thresh,
+            )
+        )
+
+    def flush(self):
+        """
+        Waits until every queued export has been written
+        """
+        self.queue.join()
+
+    def close(self):
+        """
+        Writes the queued exports and stops the writer threads
+        """
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        for catalog in self.catalogs.values():
+            catalog.close()
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+                self.write(*job)
+            except Exception:
+                self.failed += 1
+                self.logger.exception("Contour export failed")
+            finally:
+                self.queue.task_done()
+
+    def write(
+        self,
+        contour,
+        width,
+        height,
+        image,
+        folder,
+        file_hash,
+        scale,
+        slice_idx,
+        contour_idx,
+        thresh,
+    ):
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(
+            folder,
+            "{}-{}-{}-{}-{}".format(file_hash, scale, slice_idx, contour_idx, thresh),
+        )
+        save_contour(contour, width, height, path)
+        with open(path + ".txt", "w") as file:
+            file.write(np.array2string(contour, separator=",", threshold=sys.maxsize))
+        self.get_catalog(folder).add(os.path.basename(path) + ".txt")
+        self.get_archive(folder).append(
+            [contour], slice_idx, contour_idx, thresh, scale
+        )
+
+        # Save a background image for more processing
+        digest = hashlib.sha1(np.asarray(image).tobytes()).hexdigest()[:10]
+        bkg_path = os.path.join(folder, "{}-{}-{}-bkg".format(digest, scale, slice_idx))
+        with self.lock:
+            if bkg_path in self.written_backgrounds:
+                return
+            self.written_backgrounds.add(bkg_path)
+        save_image(image, bkg_path)
+
+    def get_archive(self, folder):
+        with self.lock:
+            if folder not in self.archives:
+                self.archives[folder] = ContourArchive(
+                    os.path.join(folder, ARCHIVE_NAME)
+                )
+            return self.archives[folder]
+
+    def get_catalog(self, folder):
+        with self.lock:
+            if folder not in self.catalogs:
+                self.catalogs[folder] = ContourCatalog(folder)
+            return self.catalogs[folder]
@@ -0,0 +1,117 @@
+import logging
+import queue
+import threading
+
+
+class ContourWorker:
+    """
+    Single background thread for contouring work requested from the Tk loop. Only the latest request is kept,
+    so requests made while the worker is busy replace each other, and results of requests that were superseded
+    are dropped. Results are handed back to the Tk loop by polling with after, so callbacks run on the Tk thread.
+    """
+
+    def __init__(self, widget, poll_ms=15):
+        """
+        ContourWorker constructor
+        :param widget: The Tk widget whose loop receives the results
+        :param poll_ms: The interval in milliseconds at which the Tk loop checks for results
+        """
+        self.logger = logging.getLogger(__name__)
+        self.widget = widget
+        self.poll_ms = poll_ms
+        self.condition = threading.Condition()
+        self.generation = 0
+        self.pending = None
+        self.idle = None
+        self.stopped = False
+        self.results = queue.Queue()
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        self.widget.after(self.poll_ms, self.poll)
+
+    def submit(self, fn, callback, *args):
+        """
+        Requests fn(*args) to be run in the background, replacing any request that has not started yet.
+        :param fn: The function to run, it must not touch Tk
+        :param callback: Called on the Tk thread with the result, unless a newer request was made in the meantime
+        :param args: The arguments to fn
+        """
+        with self.condition:
+            self.generation += 1
+            self.pending = (self.generation, fn, args, callback)
+            self.condition.notify()
+
+    def submit_idle(self, fn, *args):
+        """
+        Requests fn(*args) to be run in the background once there are no other requests, e.g. to precompute
+        results that are likely to be requested next. Replaces any idle request that has not started yet. Idle
+        work that runs long should check has_pending and return early.
+        :param fn: The function to run, it must not touch Tk
+        :param args: The arguments to fn
+        """
+        with self.condition:
+            self.idle = (fn, args)
+            self.condition.notify()
+
+    def has_pending(self):
+        """
+        Checks whether a request is waiting, so that long idle work can stop early and let it run
+        :return: True if a request is waiting or the worker is stopping
+        """
+        with self.condition:
+            return self.pending is not None or self.stopped
+
+    def cancel(self):
+        """
+        Drops the pending requests and the result of the running request
+        """
+        with self.condition:
+            self.generation += 1
+            self.pending = None
+            self.idle = None
+
+    def stop(self):
+        """
+        Stops the background thread once the running request is done
+        """
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.pending is None and self.idle is None and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                if self.pending is not None:
+                    job = self.pending
+                    self.pending = None
+                else:
+                    job = (None, self.idle[0], self.idle[1], None)
+                    self.idle = None
+
+            generation, fn, args, callback = job
+            try:
+                result = fn(*args)
+            except Exception:
+                self.logger.exception("Background contouring failed")
+                continue
+            if callback is not None:
+                self.results.put((generation, callback, result))
+
+    def poll(self):
+        """
+        Runs the callbacks of finished requests on the Tk thread
+        """
+        if not self.stopped:
+            self.widget.after(self.poll_ms, self.poll)
+        while True:
+            try:
+                generation, callback, result = self.results.get_nowait()
+            except queue.Empty:
+                break
+            if generation == self.generation:
+                callback(result)
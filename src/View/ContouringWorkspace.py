@@ -61,6 +61,10 @@ class ContouringWorkspace(Frame):
         menubar = self.init_menu(parent)
         parent.config(menu=menubar)
 
+        # Preprocessing progress reported by the DicomManager's background thread, shown by poll_load_progress
+        self.load_progress = None
+        self.after(200, self.poll_load_progress)
+
     def update_canvas_image(self, path):
         """
         Opens the data at path in the ResizingImageCanvas
@@ -84,6 +88,31 @@ class ContouringWorkspace(Frame):
     def update_thresh_label(self, thresh_val):
         self.thresh_label.config(text=str(thresh_val))
 
+    def update_load_progress(self, done, total):
+        """
+        Records the preprocessing progress of a DICOM study. Called from the DicomManager's background thread,
+        so it must not touch Tk
+        :param done: The number of slices processed
+        :param total: The total number of slices
+        """
+        self.load_progress = (done, total)
+
+    def poll_load_progress(self):
+        """
+        Shows the preprocessing progress in the thresh label, which shows the threshold again once preprocessing
+        is done
+        """
+        self.after(200, self.poll_load_progress)
+        progress = self.load_progress
+        if progress is None:
+            return
+        done, total = progress
+        if done < total:
+            self.thresh_label.config(text="{}%".format(100 * done // total))
+        else:
+            self.load_progress = None
+            self.update_thresh_label(self.image_canvas.thresh_val)
+
     def on_open_file(self):
         """
         Called when the user opens a file from the File menu
@@ -109,7 +138,9 @@ class ContouringWorkspace(Frame):
 
             g = glob(folder + "/*.dcm")
             if len(g) > 0:
-                dm = DicomManager(folder)
+                dm = DicomManager(
+                    folder, progress_callback=self.update_load_progress, lazy=True
+                )
                 self.image_canvas.set_dm(dm)
                 self.image_canvas.focus_set()
 
@@ -1,7 +1,6 @@
 import hashlib
 import logging
 import os
-import threading
 import time
 from tkinter import *
 
@@ -9,7 +8,29 @@ import cv2
 import numpy as np
 from PIL import Image, ImageTk
 
-from src.ImageProcessing.contouring import cnt_from_img, save_contour, save_image
+from src.ImageProcessing.contouring import ContouringEngine
+from src.ImageProcessing.pyramid import ImagePyramid
+from src.ImageProcessing.windowing import (
+    WindowedSliceCache,
+    apply_window,
+    window_presets,
+)
+from src.View.ContourExporter import ContourExporter
+from src.View.ContourWorker import ContourWorker
+
+# Number of thresholds on either side of the current one precomputed in the background
+SWEEP_RANGE = 5
+
+# Fraction of the window width a window key press moves or resizes the window by
+WINDOW_STEP = 0.05
+
+# Screen pixels a drawn contour may deviate from the computed one
+DRAW_TOLERANCE = 0.5
+
+# Zoom factor per mouse wheel step, and the zoom limits
+ZOOM_STEP = 1.25
+MIN_ZOOM = 1 / 64
+MAX_ZOOM = 32
 
 
 class ResizingImageCanvas(Canvas):
@@ -36,6 +57,11 @@ class ResizingImageCanvas(Canvas):
         self.bind("<Button-1>", self.create_point)
         self.bind("<Button-3>", self.plot_points)
         self.bind("<Button-2>", self.toggle_smoothing)
+        self.bind("<Shift-Button-1>", self.start_pan)
+        self.bind("<Shift-B1-Motion>", self.pan)
+        self.bind("<MouseWheel>", self.on_mousewheel)
+        self.bind("<Button-4>", self.on_mousewheel)
+        self.bind("<Button-5>", self.on_mousewheel)
         self.configure(cursor="crosshair red")
         self.configure()
 
@@ -43,19 +69,39 @@ class ResizingImageCanvas(Canvas):
         self.height = self.winfo_reqheight()
         self.width = self.winfo_reqwidth()
 
-        # Configure contour parameters
+        # Configure the viewport: screen pixels per image pixel, the image coordinates of the top left corner
+        # and the size of the viewport in screen pixels
+        self.zoom = 1.0
+        self.view_x = 0.0
+        self.view_y = 0.0
+        self.view_width = self.width
+        self.view_height = self.height
+        self.pan_start = None
+        self.pyramid = None
+
+        # Configure contour parameters, user points are stored in image coordinates
         self.user_points = []
+        self.user_line_visible = False
         self.spline = 0
         self.new_point = False
         self.user_line_tag = "usr_line"
         self.user_point_tag = "usr_point"
         self.contour_line_tag = "cnt_line"
         self.contour_point_tag = "cnt_point"
+        self.contour_overlay_tag = "cnt_overlay"
         self.contours = None
         self.curr_contour = 0
+        self.drawn_contour = None
         self.cnt_points = []
+        # Rasterized overlay of all contours, toggled with o. The contours are drawn once per contour set at image
+        # resolution, and the visible part is rendered through a pyramid like the image
+        self.show_all_contours = False
+        self.contour_pyramid = None
         self.contour_image = None
         self.contour_photo = None
+        self.engine = ContouringEngine()
+        self.worker = ContourWorker(self)
+        self.exporter = ContourExporter()
 
         # Configure image parameters
         self.image_path = ""
@@ -64,6 +110,19 @@ class ResizingImageCanvas(Canvas):
         self.image_idx = 0
         self.image = None
         self.photo = None
+        # The image before corrections, and the correction lines in image coordinates per slice
+        self.base_image = None
+        self.corrections = {}
+        self.correction_mask = None
+        # Intensities mapped to black and white for images that are not 8-bit, for display and contouring
+        self.window = (0, 255)
+        self.window_presets = None
+        self.window_preset = 0
+        self.windowed_slices = WindowedSliceCache()
+        # Whether the displayed slice is a preview of a slice that is still being preprocessed
+        self.slice_pending = False
+        # A single image item whose PhotoImage is updated in place
+        self.image_item = self.create_image(0, 0, anchor=NW)
 
         # Configure ROI parameters
         self.roi = None
@@ -80,7 +139,13 @@ class ResizingImageCanvas(Canvas):
     def set_dm(self, dm):
         if dm is not None:
             self.logger.info("Got new DICOMManager")
+            if self.dm is not None:
+                self.dm.close()
             self.dm = dm
+            self.slice_pending = False
+            self.corrections.clear()
+            self.windowed_slices.clear()
+            self.window_presets = None
 
     def keydispatch(self, event):
         """
@@ -104,21 +169,35 @@ class ResizingImageCanvas(Canvas):
             self.clear_points()
         if event.keysym == "c":
             self.apply_corrections()
+        if event.keysym == "z":
+            self.undo_correction()
         if event.keysym == "equal" or event.keysym == "plus":
             self.update_thresh(1)
         if event.keysym == "minus":
             self.update_thresh(-1)
         if event.keysym == "r":
             self.activate_roi()
+        if event.keysym == "bracketleft":
+            self.update_window(0, -1)
+        if event.keysym == "bracketright":
+            self.update_window(0, 1)
+        if event.keysym == "comma":
+            self.update_window(-1, 0)
+        if event.keysym == "period":
+            self.update_window(1, 0)
+        if event.keysym == "w":
+            self.next_window_preset()
+        if event.keysym == "Home":
+            self.reset_view()
+        if event.keysym == "o":
+            self.toggle_all_contours()
 
     def activate_roi(self):
         """
         Activates the region of interest that the user selected.
         """
-        img_arr = self.dm.get_image_array(self.image_idx)
-        self.roi = cv2.selectROI(
-            cv2.cvtColor(np.asarray(img_arr, np.uint8), cv2.COLOR_GRAY2BGR), False
-        )
+        img_arr = self.get_slice_array(self.image_idx)
+        self.roi = cv2.selectROI(cv2.cvtColor(img_arr, cv2.COLOR_GRAY2BGR), False)
         self.extract_roi(img_arr)
 
     def extract_roi(self, img_arr):
@@ -134,7 +213,6 @@ class ResizingImageCanvas(Canvas):
                 int(r[1]) : int(r[1] + r[3]), int(r[0]) : int(r[0] + r[2])
             ]
             img = Image.fromarray(im_crop)
-            self.image_idx %= self.dm.get_num_images()
             self.set_image(img)
 
     def update_image_idx(self, direction):
@@ -151,22 +229,106 @@ class ResizingImageCanvas(Canvas):
             self.image_idx %= len(self.image_names)
             self.open_image(path)
         else:
-            img_arr = self.dm.get_image_array(self.image_idx)
-            if self.roi_set:
-                self.extract_roi(img_arr)
-            else:
-                img = Image.fromarray(img_arr)
-                self.image_idx %= self.dm.get_num_images()
-                self.set_image(img)
+            self.image_idx %= self.dm.get_num_images()
+            self.show_slice()
 
         self.parent.update_slice_label(self.image_idx)
 
+    def show_slice(self):
+        """
+        Displays the current slice of the DicomManager, windowed to 8-bit. A slice that is still being
+        preprocessed is previewed unsmoothed, and displayed and contoured once the contour worker has it.
+        """
+        if self.dm.is_slice_ready(self.image_idx):
+            self.slice_pending = False
+            img_arr = self.get_slice_array(self.image_idx)
+        else:
+            self.slice_pending = True
+            img_arr = apply_window(
+                np.asarray(self.dm.get_preview_array(self.image_idx)), *self.window
+            )
+            self.worker.submit(self.load_slice, self.on_slice_loaded, self.image_idx)
+        if self.roi_set:
+            self.extract_roi(img_arr)
+        else:
+            self.set_image(Image.fromarray(img_arr))
+
+    def load_slice(self, idx):
+        """
+        Waits for a slice to be preprocessed. Runs on the contour worker thread.
+        :param idx: The index of the slice
+        :return: The index of the slice
+        """
+        self.dm.get_image_array(idx)
+        return idx
+
+    def on_slice_loaded(self, idx):
+        """
+        Displays a preprocessed slice on the Tk thread, unless the user has moved on to another slice.
+        :param idx: The index of the slice
+        """
+        if idx == self.image_idx:
+            self.show_slice()
+
+    def get_slice_array(self, idx):
+        """
+        Gets a slice of the DicomManager mapped to 8-bit with the current window. The same 8-bit image is
+        displayed and contoured.
+        :param idx: The index of the slice
+        :return: The windowed slice as a uint8 array
+        """
+        if self.window_presets is None:
+            self.window_presets = window_presets(
+                np.asarray(self.dm.get_image_array(idx))
+            )
+        return self.windowed_slices.get(
+            idx, self.window, lambda: self.dm.get_image_array(idx)
+        )
+
+    def update_window(self, delta_level, delta_width):
+        """
+        Moves or resizes the window used to map slices to 8-bit.
+        :param delta_level: Direction to move the window centre in
+        :param delta_width: Direction to change the window width in
+        """
+        low, high = self.window
+        step = max((high - low) * WINDOW_STEP, 1)
+        low += delta_level * step - delta_width * step / 2
+        high += delta_level * step + delta_width * step / 2
+        if high - low >= 1:
+            self.set_window((low, high))
+
+    def next_window_preset(self):
+        """
+        Switches to the next window preset of the current study.
+        """
+        if self.window_presets is None:
+            return
+        self.window_preset = (self.window_preset + 1) % len(self.window_presets)
+        name, window = list(self.window_presets.items())[self.window_preset]
+        self.logger.info("Window preset: {}".format(name))
+        self.set_window(window)
+
+    def set_window(self, window):
+        """
+        Sets the window used to map slices to 8-bit and redisplays the current slice.
+        :param window: The (low, high) window
+        """
+        self.window = window
+        self.logger.info("Window: {:.1f} - {:.1f}".format(*window))
+        if self.dm is not None:
+            self.show_slice()
+        elif self.base_image is not None:
+            self.set_image(self.base_image)
+
     def update_contour_idx(self, direction):
         """
         Updates the visible contour on user input.
         :param direction: An integer representing whether or not we're incrementing or decrementing
         """
         self.logger.debug("Current contour: {}".format(self.curr_contour))
+        if not self.ready:
+            return
         valid_contour = 0 <= self.curr_contour + direction < len(self.contours) - 1
         if valid_contour:
             self.curr_contour += direction
@@ -184,21 +346,148 @@ class ResizingImageCanvas(Canvas):
 
     def set_image(self, image):
         """
-        Sets up a PhotoImage from the provided PIL image so the Canvas can display.
+        Displays the provided PIL image with the corrections of the current slice. The viewport is kept, unless
+        the image size changed.
         :param image: An Image
         """
         if image is not None:
-            self.image = image
-            self.photo = ImageTk.PhotoImage(self.image)
-            self.width = self.photo.width()
-            self.height = self.photo.height()
-            thread = threading.Thread(target=self.update_contours, args=())
-            thread.start()
-            self.create_image(0, 0, anchor=NW, image=self.photo)
+            self.base_image = image
+            self.image = self.composite_corrections(image)
+            self.pyramid = ImagePyramid(np.asarray(self.get_display_image(image)))
+            self.delete(self.contour_line_tag)
+            self.delete(self.contour_overlay_tag)
+            self.drawn_contour = None
+            if image.size != (self.width, self.height):
+                self.width, self.height = image.size
+                self.view_width, self.view_height = image.size
+                self.zoom = 1.0
+                self.view_x = self.view_y = 0.0
+                self.config(width=self.width, height=self.height)
+                self.parent.config(width=self.width, height=self.height)
+            self.render()
+            self.update_contours()
         else:
-            self.create_image(0, 0, anchor=NW)
-        self.config(width=self.width, height=self.height)
-        self.parent.config(width=self.width, height=self.height)
+            self.config(width=self.width, height=self.height)
+            self.parent.config(width=self.width, height=self.height)
+
+    def render(self):
+        """
+        Draws the visible part of the image at the current zoom, reusing the PhotoImage when the viewport size
+        has not changed, and redraws the overlays.
+        """
+        if self.pyramid is None:
+            return
+        display = Image.fromarray(
+            self.pyramid.render(
+                self.zoom, self.view_x, self.view_y, self.view_width, self.view_height
+            )
+        )
+        photo_size = None
+        if self.photo is not None:
+            photo_size = (self.photo.width(), self.photo.height())
+        if photo_size == display.size:
+            self.photo.paste(display)
+        else:
+            self.photo = ImageTk.PhotoImage(display)
+            self.itemconfigure(self.image_item, image=self.photo)
+        self.redraw_overlays()
+
+    def redraw_overlays(self):
+        """
+        Redraws the user points and lines and the displayed contours for the current viewport.
+        """
+        self.draw_all_contours()
+        self.delete(self.user_point_tag)
+        for x, y in self.image_to_canvas(self.get_point_list(self.user_points)):
+            self.create_oval(
+                x, y, x + 1, y + 1, outline="red", fill="red", tag=self.user_point_tag
+            )
+        if self.user_line_visible:
+            self.draw_user_line()
+        # The selected contour is dropped when new contours are requested, see update_contours
+        if self.ready and self.drawn_contour is not None:
+            self.draw_contour(self.drawn_contour)
+
+    def image_to_canvas(self, points):
+        """
+        Converts image coordinates to canvas coordinates.
+        :param points: An (N, 2) array-like of x/y image coordinates
+        :return: An (N, 2) array of canvas coordinates
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        return (points - (self.view_x, self.view_y)) * self.zoom
+
+    def canvas_to_image(self, x, y):
+        """
+        Converts canvas coordinates to image coordinates.
+        :param x: The canvas x coordinate
+        :param y: The canvas y coordinate
+        :return: The image x and y coordinates
+        """
+        return x / self.zoom + self.view_x, y / self.zoom + self.view_y
+
+    def on_resize(self, event):
+        """
+        Renders the image for the new viewport size.
+        :param event: The configure event
+        """
+        self.view_width = max(event.width, 1)
+        self.view_height = max(event.height, 1)
+        self.render()
+
+    def on_mousewheel(self, event):
+        """
+        Zooms in or out around the mouse cursor.
+        :param event: The mouse wheel event
+        """
+        direction = 1 if event.num == 4 or getattr(event, "delta", 0) > 0 else -1
+        x, y = self.canvas_to_image(event.x, event.y)
+        self.zoom = min(max(self.zoom * ZOOM_STEP**direction, MIN_ZOOM), MAX_ZOOM)
+        self.view_x = x - event.x / self.zoom
+        self.view_y = y - event.y / self.zoom
+        self.render()
+
+    def start_pan(self, event):
+        """
+        Starts panning the image with the mouse.
+        :param event: The click event
+        """
+        self.pan_start = (event.x, event.y, self.view_x, self.view_y)
+
+    def pan(self, event):
+        """
+        Pans the image with the mouse.
+        :param event: The motion event
+        """
+        if self.pan_start is None:
+            return
+        x, y, view_x, view_y = self.pan_start
+        self.view_x = view_x - (event.x - x) / self.zoom
+        self.view_y = view_y - (event.y - y) / self.zoom
+        self.render()
+
+    def reset_view(self):
+        """
+        Shows the whole image at full resolution from the top left corner.
+        """
+        self.zoom = 1.0
+        self.view_x = self.view_y = 0.0
+        self.render()
+
+    def get_display_image(self, image):
+        """
+        Converts an Image to 8-bit for display. The current window is applied to single channel 16-bit, 32-bit
+        and float images, other modes are converted to greyscale or RGB.
+        :param image: An Image
+        :return: An 8-bit Image
+        """
+        if image.mode in ("L", "RGB"):
+            return image
+        if image.mode in ("I", "F") or image.mode.startswith("I;16"):
+            return Image.fromarray(apply_window(np.asarray(image), *self.window))
+        if image.mode in ("1", "LA"):
+            return image.convert("L")
+        return image.convert("RGB")
 
     def update_thresh(self, delta_thresh):
         """
@@ -215,6 +504,7 @@ class ResizingImageCanvas(Canvas):
         :param folder: A path to the folder
         """
         self.image_folder = folder
+        self.corrections.clear()
         self.image_names = os.listdir(folder)
         for name in self.image_names:
             if os.path.isdir(os.path.join(folder, name)):
@@ -227,47 +517,110 @@ class ResizingImageCanvas(Canvas):
 
     def update_contours(self):
         """
-        Updates the computed contours for the current Image.
+        Requests the contours for the current Image from the contour worker. Requests that are superseded
+        before they finish, e.g. while scrolling through slices, are dropped.
         """
         self.ready = False
+        self.contours = None
+        self.contour_pyramid = None
+        self.curr_contour = 0
+        self.drawn_contour = None
+        self.delete(self.contour_line_tag)
         self.configure(cursor="clock")
+        if self.slice_pending:
+            # The contours are requested once the slice is preprocessed, see on_slice_loaded
+            return
+        self.worker.submit(
+            self.compute_contours, self.on_contours, self.image, self.thresh_val
+        )
 
-        self.contours = []
+    def compute_contours(self, image, thresh_val):
+        """
+        Computes the contours of an Image. Runs on the contour worker thread.
+        :param image: The Image to contour
+        :param thresh_val: The binary threshold value
+        :return: The contours, sorted by area from largest to smallest
+        """
+        self.engine.set_image(image)
+        return self.engine.contours(thresh_val)
+
+    def on_contours(self, contours):
+        """
+        Receives the contours for the current Image on the Tk thread.
+        :param contours: The contours computed by compute_contours
+        """
+        self.contours = contours
+        self.contour_pyramid = None
         self.curr_contour = 0
-        self.contours = cnt_from_img(self.image, self.thresh_val)
         self.logger.debug("Got {} contours".format(len(self.contours)))
 
         self.ready = True
         self.configure(cursor="crosshair red")
+        self.draw_all_contours()
+
+        # Precompute the neighbouring thresholds so +/- does not have to wait, nearest first, and stop as soon as
+        # the user makes a new request
+        thresh_values = sorted(
+            range(self.thresh_val - SWEEP_RANGE, self.thresh_val + SWEEP_RANGE + 1),
+            key=lambda thresh_val: abs(thresh_val - self.thresh_val),
+        )
+        self.worker.submit_idle(
+            self.engine.sweep, thresh_values, self.worker.has_pending
+        )
 
     def apply_corrections(self):
         """
-        Updates the image given the user's inputted corrections and updates the contours.
+        Adds the line through the user's points to the corrections of the current slice and updates the
+        contours.
         """
-        point_list = self.get_point_list(self.user_points)
-        point_list_len = len(point_list)
-        im = None
-        for i in range(point_list_len):
-            j = i + 1
-            self.logger.debug(
-                "i: {}, j: {}, point_list_len: {}".format(i, j, point_list_len)
-            )
-            if j <= point_list_len - 1:
-                self.logger.debug(
-                    "Drawing points {} and {}".format(point_list[i], point_list[j])
-                )
-                im = np.array(self.image.convert("RGB"))
-
-                im = cv2.line(
-                    im,
-                    point_list[i],
-                    point_list[j],
-                    thickness=2,
-                    color=(255, 255, 255),
-                    lineType=cv2.LINE_AA,
-                )
-                self.image = Image.fromarray(im)
-        self.update_contours()
+        if len(self.user_points) < 4:
+            return
+        line = np.array(self.get_point_list(self.user_points), dtype=np.int32)
+        self.corrections.setdefault(self.correction_key(), []).append(line)
+        self.logger.debug("Applying correction with {} points".format(len(line)))
+        self.set_image(self.base_image)
+
+    def undo_correction(self):
+        """
+        Removes the last correction of the current slice and updates the contours.
+        """
+        lines = self.corrections.get(self.correction_key())
+        if lines:
+            lines.pop()
+            self.set_image(self.base_image)
+
+    def correction_key(self):
+        """
+        Gets the key of the corrections of the current slice. Corrections made in a ROI are kept separately, as
+        their coordinates are relative to the ROI.
+        """
+        return self.image_idx, tuple(self.roi) if self.roi_set else None
+
+    def composite_corrections(self, image):
+        """
+        Draws the corrections of the current slice into a mask with a single cv2.polylines call and composites
+        it over image.
+        :param image: The Image without corrections
+        :return: The corrected Image, or image itself if the slice has no corrections
+        """
+        lines = self.corrections.get(self.correction_key())
+        if not lines:
+            self.correction_mask = None
+            return image
+
+        self.correction_mask = np.zeros((image.height, image.width), dtype=np.uint8)
+        cv2.polylines(
+            self.correction_mask,
+            lines,
+            False,
+            color=255,
+            thickness=2,
+            lineType=cv2.LINE_AA,
+        )
+        im = np.array(self.get_display_image(image))
+        mask = self.correction_mask if im.ndim == 2 else self.correction_mask[..., None]
+        np.maximum(im, mask, out=im)
+        return Image.fromarray(im)
 
     def draw_contour(self, cnt_idx):
         """
@@ -277,30 +630,75 @@ class ResizingImageCanvas(Canvas):
         if self.ready:
             self.delete(self.contour_point_tag)
             self.delete(self.contour_line_tag)
-            self.cnt_points.clear()
-
-            for point in self.contours[cnt_idx]:
-                point_x = point[0][0]
-                point_y = point[0][1]
-                self.cnt_points.append(point_x)
-                self.cnt_points.append(point_y)
-            kwargs = {
-                "tags": self.contour_line_tag,
-                "width": 2,
-                "fill": "red",
-                "joinstyle": "round",
-                "capstyle": "round",
-            }
-            self.itemconfigure(self.contour_line_tag, smooth=1)
-            self.create_line(self.cnt_points, kwargs)
+
+            self.drawn_contour = cnt_idx
+            points = self.image_to_canvas(self.decimate_contour(self.contours[cnt_idx]))
+            self.cnt_points = points.ravel().tolist()
+            self.create_line(
+                self.cnt_points,
+                tags=self.contour_line_tag,
+                width=2,
+                fill="red",
+                joinstyle="round",
+                capstyle="round",
+            )
         else:
             self.contours_not_ready()
 
+    def decimate_contour(self, contour):
+        """
+        Drops the contour points that do not change the drawn contour by more than DRAW_TOLERANCE screen pixels
+        at the current zoom, using Douglas-Peucker.
+        :param contour: A contour as returned by OpenCV
+        :return: The decimated contour
+        """
+        return cv2.approxPolyDP(contour, DRAW_TOLERANCE / self.zoom, True)
+
+    def toggle_all_contours(self):
+        """
+        Toggles the overlay that shows all contours of the current Image at once.
+        """
+        self.show_all_contours = not self.show_all_contours
+        self.draw_all_contours()
+
+    def draw_all_contours(self):
+        """
+        Shows all contours of the current Image as a single transparent overlay image for the current viewport,
+        so that the number of contours does not affect the number of canvas items. The contours are rasterized
+        once per contour set, so panning and zooming only render the visible part of the raster.
+        """
+        self.delete(self.contour_overlay_tag)
+        if not self.show_all_contours or not self.ready or not self.contours:
+            return
+
+        if self.contour_pyramid is None:
+            mask = np.zeros(self.pyramid.shape[:2], dtype=np.uint8)
+            cv2.drawContours(mask, self.contours, -1, color=255, thickness=1)
+            self.contour_pyramid = ImagePyramid(mask)
+        mask = self.contour_pyramid.render(
+            self.zoom, self.view_x, self.view_y, self.view_width, self.view_height
+        )
+        overlay = np.zeros((self.view_height, self.view_width, 4), dtype=np.uint8)
+        overlay[mask > 0] = (255, 255, 0, 255)
+        self.contour_image = Image.fromarray(overlay, "RGBA")
+        self.contour_photo = ImageTk.PhotoImage(self.contour_image)
+        self.create_image(
+            0, 0, anchor=NW, image=self.contour_photo, tags=self.contour_overlay_tag
+        )
+        # Keep the overlay below the selected contour and the user's points
+        self.tag_raise(self.contour_overlay_tag, self.image_item)
+
     def export_contour(self, cnt_idx):
         """
-        Exports the current contour profile to file.
+        Exports the current contour profile to file. The files are written in the background by the exporter.
         :param cnt_idx: The contour to write
         """
+        if not self.ready:
+            self.contours_not_ready()
+            return
+        if not 0 <= cnt_idx < len(self.contours):
+            return
+
         if self.dm:
             new_path = self.dm.get_output_path()
         else:
@@ -313,51 +711,29 @@ class ResizingImageCanvas(Canvas):
         time_hash.update(str(time.time()).encode("utf-8"))
         file_name_hash = "{}".format(time_hash.hexdigest()[:10])
 
-        scaling_factor = self.dm.get_scaling_factor()
+        scaling_factor = self.dm.get_scaling_factor() if self.dm else 1
 
-        contour_img_path = os.path.join(
+        self.exporter.export(
+            self.contours[cnt_idx],
+            self.width,
+            self.height,
+            self.image,
             new_path,
-            "{}-{}-{}-{}-{}".format(
-                file_name_hash,
-                scaling_factor,
-                self.image_idx,
-                self.curr_contour,
-                self.thresh_val,
-            ),
-        )
-
-        contour_string_path = os.path.join(
-            new_path,
-            "{}-{}-{}-{}-{}.txt".format(
-                file_name_hash,
-                scaling_factor,
-                self.image_idx,
-                self.curr_contour,
-                self.thresh_val,
-            ),
-        )
-
-        try:
-            os.mkdir(new_path)
-        except OSError:
-            # directory already exists
-            pass
-
-        thread = threading.Thread(
-            target=save_contour,
-            args=(self.contours[cnt_idx], self.width, self.height, contour_img_path),
+            file_name_hash,
+            scaling_factor,
+            self.image_idx,
+            self.curr_contour,
+            self.thresh_val,
         )
-        thread.start()
-
-        # Save a background image for more processing
-        bkg_save_path = contour_img_path + "-bkg"
-        thread = threading.Thread(target=save_image, args=(self.image, bkg_save_path))
-        thread.start()
 
-        file = open(contour_string_path, "w")
-        np.set_printoptions(threshold=np.nan)
-        file.write(np.array2string(self.contours[cnt_idx], separator=","))
-        file.close()
+    def close(self):
+        """
+        Writes the pending exports and stops the background threads.
+        """
+        self.worker.stop()
+        self.exporter.close()
+        if self.dm is not None:
+            self.dm.close()
 
     @staticmethod
     def contours_not_ready():
@@ -384,28 +760,38 @@ class ResizingImageCanvas(Canvas):
             fill="red",
             tag=self.user_point_tag,
         )
-        self.user_points.append(event.x)
-        self.user_points.append(event.y)
+        x, y = self.canvas_to_image(event.x, event.y)
+        self.user_points.append(int(round(x)))
+        self.user_points.append(int(round(y)))
 
-    def plot_points(self):
+    def plot_points(self, event=None):
         """
         Plots the connections between the points that the user selected.
         """
         if self.new_point and len(self.user_points) > 2:
-            self.delete(self.user_line_tag)
             self.spline = 0
-            self.create_line(
-                self.user_points,
-                tags=self.user_line_tag,
-                width=2,
-                fill="red",
-                joinstyle="round",
-                capstyle="round",
-            )
+            self.user_line_visible = True
+            self.draw_user_line()
 
         self.new_point = False
 
-    def toggle_smoothing(self):
+    def draw_user_line(self):
+        """
+        Draws the connections between the points that the user selected for the current viewport.
+        """
+        self.delete(self.user_line_tag)
+        points = self.image_to_canvas(self.get_point_list(self.user_points))
+        self.create_line(
+            points.ravel().tolist(),
+            tags=self.user_line_tag,
+            width=2,
+            fill="red",
+            joinstyle="round",
+            capstyle="round",
+            smooth=self.spline,
+        )
+
+    def toggle_smoothing(self, event=None):
         """
         Toggles between smooth and connect the dot plots for the connections between points.
         :return:
@@ -422,6 +808,7 @@ class ResizingImageCanvas(Canvas):
         Clears the points that the user selected.
         """
         self.user_points.clear()
+        self.user_line_visible = False
         self.delete(self.user_point_tag)
         self.delete(self.user_line_tag)
 
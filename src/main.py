@@ -10,8 +10,9 @@ logger = logging.getLogger(__name__)
 
 def main():
     root = Tk()
-    ContouringWorkspace(root)
+    workspace = ContouringWorkspace(root)
     root.mainloop()
+    workspace.image_canvas.close()
 
 
 if __name__ == "__main__":